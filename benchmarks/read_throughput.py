@@ -0,0 +1,72 @@
+"""Cost model of serving the HEARTBEAT/TOD PVs to polling CA clients.
+
+Before the clock cache, CameraDriver.read called IocAdmin.tod()/heartbeat()
+on every client read. Now IocAdmin.update_clock() refreshes both PVs once a
+second and reads are served from the driver parameter cache. This times the
+shipped IocAdmin methods: tod()/heartbeat() per read for "before", and one
+update_clock() per second on a stub driver plus a parameter lookup per read
+for "after". The stub stands in for pcaspy's parameter store, so the result
+is a model of the CPU time per second spent on these PVs at a given client
+read rate, not a measured CA read throughput.
+
+pcaspy must be importable since the admin module uses it, but no server is
+created.
+"""
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'pyADioc'))
+
+from admin import IocAdmin
+
+# client reads per second of each PV
+READ_RATES = [10, 1000, 100000]
+
+
+class StubDriver(object):
+    """The parameter cache calls update_clock makes on the driver."""
+    def __init__(self):
+        self.params = {}
+
+    def setParam(self, reason, value):
+        self.params[reason] = value
+
+    def getParam(self, reason):
+        return self.params[reason]
+
+    def updatePV(self, reason):
+        pass
+
+
+def make_admin():
+    # skip __init__, which starts the ticker and autosave threads
+    admin = IocAdmin.__new__(IocAdmin)
+    admin.start_int = int(time.time())
+    admin.driver = StubDriver()
+    admin.update_clock()
+    return admin
+
+
+def bench(func, number):
+    """Returns the best time of one call in seconds."""
+    return min(timeit.repeat(func, number=number, repeat=5)) / number
+
+
+def main(number=100000):
+    admin = make_admin()
+    tick = bench(admin.update_clock, number)
+    print "update_clock: %.2f us per tick (both PVs, once a second)" % (tick * 1.e6)
+    print
+    print "%-10s %10s %16s %16s" % ('PV', 'reads/s', 'before (us/s)', 'after (us/s)')
+    for reason, method in (('HEARTBEAT', admin.heartbeat), ('TOD', admin.tod)):
+        before = bench(lambda: method(), number)
+        lookup = bench(lambda: admin.driver.getParam(reason), number)
+        for rate in READ_RATES:
+            print "%-10s %10d %16.1f %16.1f" % (
+                reason, rate, rate * before * 1.e6, (tick + rate * lookup) * 1.e6)
+
+
+if __name__ == '__main__':
+    main()
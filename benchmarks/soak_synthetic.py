@@ -0,0 +1,131 @@
+"""Soak test of the frame generation path without a CA server.
+
+Drives SyntheticReceive -> FrameState.generate -> SoakMonitor for a fixed
+duration, so it can run unattended from CI or cron. The exit code is 3 if
+the RSS grew steadily over the run (the same verdict as `pycamioc --soak`)
+and 0 otherwise, e.g.
+
+    python benchmarks/soak_synthetic.py opal1k --rate 120 --duration 3600
+
+pcaspy must be importable since FrameState lives in the IOC module, but no
+server is created.
+"""
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'pyADioc'))
+
+import db
+import logs
+import soak
+import daqts
+from ioc import FrameState
+
+LOG = logging.getLogger('soak_synthetic')
+
+
+def parse_cli():
+    parser = argparse.ArgumentParser(
+        description='Soak test of the synthetic frame generation path'
+    )
+
+    parser.add_argument(
+        'camera_type',
+        metavar='CAMTYPE',
+        help='The camera type to simulate'
+    )
+
+    parser.add_argument(
+        '--rate',
+        metavar='RATE',
+        type=float,
+        default=120.0,
+        help='the synthetic event rate in Hz (default: 120)'
+    )
+
+    parser.add_argument(
+        '--duration',
+        metavar='SECONDS',
+        type=float,
+        default=600.0,
+        help='the length of the run (default: 600)'
+    )
+
+    parser.add_argument(
+        '--interval',
+        metavar='INTERVAL',
+        type=float,
+        default=10.0,
+        help='the soak sampling interval in seconds (default: 10)'
+    )
+
+    parser.add_argument(
+        '--outdir',
+        metavar='OUTDIR',
+        default=None,
+        help='keep the soak snapshots in this directory (default: a temporary directory)'
+    )
+
+    parser.add_argument(
+        '--log-level',
+        metavar='LOG_LEVEL',
+        default='INFO',
+        help='the logging level of the client (default INFO)'
+    )
+
+    return parser.parse_args()
+
+
+def run(camera_type, rate, duration, interval, outdir):
+    pvdb = db.init(camera_type)
+    if pvdb is None:
+        LOG.error('Unsupported camera type: %s', camera_type)
+        return 2
+    config = { reason : info['value'] for reason, info in pvdb.iteritems() if info.get('config') and 'value' in info }
+    shape = (pvdb['IMAGE1:ArraySize1_RBV']['value'], pvdb['IMAGE1:ArraySize0_RBV']['value'])
+    state = FrameState(config, shape, pvdb['IMAGE1:BitsPerPixel_RBV']['value'], db.get_dtype(camera_type), 0, 0)
+
+    monitor = soak.SoakMonitor(outdir, interval, 10, lambda stats: LOG.debug('%s', stats))
+    ts = daqts.SyntheticReceive(rate, 1)
+    ts.start()
+    monitor.start()
+    nframes = 0
+    end = time.time() + duration
+    try:
+        while time.time() < end:
+            try:
+                ts.get(timeout=1.0)
+            except daqts.TimeoutException:
+                continue
+            # hold on to the frame like the CA server does until the next one
+            frame = state.generate()
+            nframes += 1
+    finally:
+        ts.stop()
+        growing = monitor.stop()
+
+    LOG.info('Generated %d frames, %d timestamps dropped, %d soak samples',
+             nframes, ts.dropped, len(monitor.samples))
+    return 3 if growing else 0
+
+
+def main():
+    args = parse_cli()
+    log_level = getattr(logging, args.log_level.upper(), logging.INFO)
+    log_listener = logs.setup_logging(log_level)
+    outdir = args.outdir or tempfile.mkdtemp(prefix='soak_')
+    try:
+        return run(args.camera_type, args.rate, args.duration, args.interval, outdir)
+    finally:
+        if args.outdir is None:
+            shutil.rmtree(outdir, ignore_errors=True)
+        log_listener.stop()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,6 +6,9 @@ import datetime
 import threading
 
 from pcaspy import Severity, Alarm
+import soak
+import metrics
+from profiler import Profiler, MODES as PROFILE_MODES
 
 LOG = logging.getLogger(__name__)
 
@@ -17,12 +20,10 @@ class IocAdmin(object):
     ioc_pvdb = {
         'HEARTBEAT' : {
             'type' : 'int',
-            'scan' : 1,
             'readonly' : True,
         },
         'TOD' : {
             'type' : 'string',
-            'scan' : 1,
             'readonly' : True,
         },
         'STARTTOD' : {
@@ -32,7 +33,23 @@ class IocAdmin(object):
         'SYSRESET' : {
             'type' : 'int',
         },
+        'PROFILE' : {
+            'type' : 'enum',
+            'enums' : ['Off', 'On'],
+            'command' : True,
+        },
+        'PROFMODE' : {
+            'type' : 'enum',
+            'enums' : PROFILE_MODES,
+        },
+        'PROFPATH' : {
+            'type' : 'char',
+            'count' : 512,
+            'readonly' : True,
+        },
     }
+    ioc_pvdb.update(metrics.init_pvdb())
+    ioc_pvdb.update(soak.init_pvdb())
 
     def __init__(self, name, prefix, driver, ioc_data=None):
         self.run = True
@@ -71,6 +88,19 @@ class IocAdmin(object):
         # Set up the IOC pvs
         self.start_int = int(time.time())
         self.start_str = self.tod()
+        self.driver.setParam('STARTTOD', self.start_str)
+        self.profiler = Profiler(self.make_output_dir('profile'))
+        self.soak = None
+        self.soak_growing = False
+        self.metrics = metrics.Registry({'prefix': self.driver.prefix})
+        self.update_clock()
+        # start the ticker thread which refreshes the cached clock and metric PVs
+        LOG.debug('Starting clock ticker thread')
+        self.ticking = threading.Event()
+        self.ticking.set()
+        self.tick_id = threading.Thread(name="ticker", target=self.runTicker)
+        self.tick_id.setDaemon(True)
+        self.tick_id.start()
         # start autosave thread if autosave is enabled
         if self.autosave:
             LOG.debug('Starting autosave thread')
@@ -96,6 +126,20 @@ class IocAdmin(object):
         """Return the time of day this IOC was last rebooted."""
         return self.start_str
 
+    def update_clock(self):
+        """Refresh the cached HEARTBEAT and TOD PVs and post monitors."""
+        self.driver.setParam('HEARTBEAT', self.heartbeat())
+        self.driver.setParam('TOD', self.tod())
+        self.driver.updatePV('HEARTBEAT')
+        self.driver.updatePV('TOD')
+
+    def update_metrics(self):
+        """Collect the metrics registry and refresh the metric PVs."""
+        self.metrics.collect()
+        for metric in self.metrics.metrics:
+            self.driver.setParam(metric.reason, metric.value)
+            self.driver.updatePV(metric.reason)
+
     def pv_list_lines(self, prefix, d):
         """Helper function to get the lines for the IOC.pvlist file in make_pv_list."""
         lines = []
@@ -147,6 +191,43 @@ class IocAdmin(object):
                 raise IOError("Filename conflict for autosave directory")
         LOG.debug('Autosave directory: %s', self.my_dir)
 
+    def make_output_dir(self, kind):
+        """Returns the directory profiler or soak output is written to."""
+        if self.name:
+            return self.ioc_data + "/{0}/{1}".format(self.name, kind)
+        else:
+            return kind + "_" + self.prefix.replace(":", "_").lower()
+
+    def start_soak(self, interval, top):
+        """Starts the soak monitor sampling every interval seconds."""
+        self.soak = soak.SoakMonitor(self.make_output_dir('soak'), interval, top, self.soak_update)
+        self.soak.start()
+
+    def soak_update(self, stats):
+        """Publishes a soak monitor sample."""
+        for reason, value in stats.iteritems():
+            self.driver.setParam(reason, value)
+        if stats['SOAK:Growing']:
+            self.driver.setParamStatus('SOAK:Growing', Alarm.HIGH_ALARM, Severity.MINOR_ALARM)
+        else:
+            self.driver.setParamStatus('SOAK:Growing', Alarm.NO_ALARM, Severity.NO_ALARM)
+        for reason in stats:
+            self.driver.updatePV(reason)
+
+    def profile(self, value, wait=False):
+        """Starts or stops the profiler, used by the PROFILE command PV."""
+        if value:
+            return self.profiler.start(PROFILE_MODES[self.driver.getParam('PROFMODE')])
+        else:
+            self.profiler.stop(self.profile_done, wait)
+            return True
+
+    def profile_done(self, path):
+        """Publishes the location of the profiler output."""
+        if path is not None:
+            self.driver.setParam('PROFPATH', path)
+            self.driver.updatePV('PROFPATH')
+
     def set_autosave_file(self):
         """Picks a name for the autosave file."""
         date_string = str(datetime.datetime.now())
@@ -159,11 +240,13 @@ class IocAdmin(object):
         """Serializes all values into a JSON object."""
         try:
             LOG.debug('Starting autosave update')
+            start = time.time()
             value_dict = {}
             for reason in self.savereq:
                 value_dict[reason] = self.driver.getParam(reason)
             with open(self.autosave_filename, "w") as f:
                 f.write(json.dumps(value_dict, sort_keys = True, indent = 4) + "\n")
+            self.metrics['autosave_duration_seconds'].set(time.time() - start)
             LOG.debug('Autosave update completed')
         except StandardError as e:
             LOG.error('Autosave error: %s', e)
@@ -227,6 +310,16 @@ class IocAdmin(object):
             save_files = self.list_autosaves()
 
     def shutdown(self):
+        if self.profiler.active:
+            LOG.debug('Writing results of the running profiler')
+            self.profile(0, wait=True)
+        LOG.debug('Clock ticker shutdown requested')
+        self.ticking.clear()
+        self.tick_id.join()
+        self.metrics.shutdown()
+        if self.soak is not None:
+            LOG.debug('Soak monitor shutdown requested')
+            self.soak_growing = self.soak.stop()
         if self.autosave:
             LOG.debug('Autosave shutdown requested')
             self.run = False
@@ -238,3 +331,11 @@ class IocAdmin(object):
             self.save_values()
         LOG.debug('Autosave thread exitting...')
 
+    def runTicker(self):
+        while self.ticking.is_set():
+            # wake up just after the next whole second
+            time.sleep(1.0 - (time.time() % 1.0))
+            self.update_clock()
+            self.update_metrics()
+        LOG.debug('Clock ticker thread exitting...')
+
@@ -0,0 +1,82 @@
+import os
+import ctypes
+import ctypes.util
+import logging
+
+LOG = logging.getLogger(__name__)
+
+SCHED_OTHER = 0
+SCHED_FIFO = 1
+CPU_SETSIZE = 1024
+
+_libc = None
+
+
+class SchedParam(ctypes.Structure):
+    _fields_ = [('sched_priority', ctypes.c_int)]
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return _libc
+
+def _check(ret):
+    if ret != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+def parse_cpus(cpus):
+    """Parses a cpu list like '0-3,6' into a set of cpu numbers."""
+    parsed = set()
+    for part in cpus.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            low, high = part.split('-', 1)
+            parsed.update(range(int(low), int(high) + 1))
+        else:
+            parsed.add(int(part))
+    if any(cpu < 0 or cpu >= CPU_SETSIZE for cpu in parsed):
+        raise ValueError("cpu list %s is out of range [0-%d]" % (cpus, CPU_SETSIZE - 1))
+    return parsed
+
+def set_affinity(cpus):
+    """Pins the calling thread to the set of cpus."""
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    else:
+        mask = (ctypes.c_ulong * (CPU_SETSIZE // (8 * ctypes.sizeof(ctypes.c_ulong))))()
+        bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+        for cpu in cpus:
+            mask[cpu // bits] |= 1 << (cpu % bits)
+        _check(_get_libc().sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)))
+
+def set_fifo(priority):
+    """Switches the calling thread to SCHED_FIFO at the given priority."""
+    if hasattr(os, 'sched_setscheduler'):
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+    else:
+        param = SchedParam(priority)
+        _check(_get_libc().sched_setscheduler(0, SCHED_FIFO, ctypes.byref(param)))
+
+def apply(name, cpus=None, priority=None):
+    """Applies the scheduling options to the calling thread.
+
+    Failures (e.g. missing CAP_SYS_NICE for SCHED_FIFO) are logged rather
+    than raised so an IOC still starts on a node without the privileges.
+    """
+    if cpus:
+        try:
+            set_affinity(cpus)
+            LOG.info('Pinned %s to cpus %s', name, ','.join(str(cpu) for cpu in sorted(cpus)))
+        except (OSError, AttributeError) as exc:
+            LOG.warning('Could not set the cpu affinity of %s: %s', name, exc)
+    if priority:
+        try:
+            set_fifo(priority)
+            LOG.info('Set %s to SCHED_FIFO priority %d', name, priority)
+        except (OSError, AttributeError) as exc:
+            LOG.warning('Could not set the SCHED_FIFO priority of %s: %s', name, exc)
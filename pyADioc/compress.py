@@ -0,0 +1,112 @@
+import time
+import logging
+import threading
+import numpy as np
+
+from multiprocessing.pool import ThreadPool
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+LOG = logging.getLogger(__name__)
+
+CODECS = ['lz4', 'zstd', 'blosc-lz4', 'blosc-zstd']
+ZSTD_LEVEL = 1
+BLOSC_LEVEL = 5
+
+
+def available(codec):
+    """Returns True if the python module needed by the codec is installed."""
+    if codec == 'lz4':
+        return lz4frame is not None
+    elif codec == 'zstd':
+        return zstd is not None
+    elif codec.startswith('blosc-'):
+        return blosc is not None
+    else:
+        return False
+
+
+class Compressor(object):
+    """Encodes frames on a pool of worker threads.
+
+    The codecs release the GIL while compressing so the encoding runs in
+    parallel with the acquisition loop. The callback is invoked from the
+    pool's result thread with a (seq, fid, data, nbytes, elapsed) tuple where
+    data is the encoded frame as a uint8 array. Frames submitted while
+    nworkers * 2 encodes are already pending are dropped rather than queued.
+    """
+    def __init__(self, codec, nworkers, callback):
+        if codec not in CODECS:
+            raise ValueError("Unknown compression codec: %s" % codec)
+        if not available(codec):
+            raise ValueError("The python module for the %s codec is not installed" % codec)
+        self.codec = codec
+        self.callback = callback
+        self.max_pending = nworkers * 2
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.pool = ThreadPool(nworkers)
+
+    def encode(self, frame):
+        if self.codec == 'lz4':
+            return lz4frame.compress(frame)
+        elif self.codec == 'zstd':
+            # compressor objects are not thread-safe so keep one per worker
+            if not hasattr(self.local, 'zstd'):
+                self.local.zstd = zstd.ZstdCompressor(level=ZSTD_LEVEL)
+            return self.local.zstd.compress(frame)
+        else:
+            return blosc.compress_ptr(
+                frame.__array_interface__['data'][0],
+                frame.size,
+                typesize=frame.itemsize,
+                clevel=BLOSC_LEVEL,
+                shuffle=blosc.BITSHUFFLE,
+                cname=self.codec.split('-', 1)[1],
+            )
+
+    def submit(self, seq, fid, frame):
+        """Queues a frame for compression, returns False if it was dropped."""
+        with self.lock:
+            if self.pending >= self.max_pending:
+                return False
+            self.pending += 1
+        self.pool.apply_async(self._run, (seq, fid, frame), callback=self._done)
+        return True
+
+    def _run(self, seq, fid, frame):
+        start = time.time()
+        try:
+            data = np.frombuffer(self.encode(frame), dtype=np.uint8)
+        except Exception as exc:
+            LOG.error('Compression of frame %d failed: %s', seq, exc)
+            data = None
+        return seq, fid, data, frame.nbytes, time.time() - start
+
+    def _done(self, result):
+        with self.lock:
+            self.pending -= 1
+        if result[2] is not None:
+            # an exception here would kill the pool's result handler thread
+            try:
+                self.callback(result)
+            except Exception as exc:
+                LOG.error('Compressed frame %d callback failed: %s', result[0], exc)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
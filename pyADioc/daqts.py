@@ -1,4 +1,5 @@
 import os
+import time
 import socket
 import fcntl
 import struct
@@ -7,7 +8,10 @@ import logging
 import argparse
 import multiprocessing as mp
 import threading
+import affinity
+import logs
 import Queue
+import collections
 from collections import namedtuple
 
 LOG = logging.getLogger('daqts')
@@ -18,7 +22,8 @@ MCAST_PORT = 10150
 MIN_PLATFORM = 0
 MAX_PLATFORM = 4
 
-FMT_STR = '[ %(asctime)s | %(levelname)-8s] %(message)s'
+# not exported by the socket module of older pythons
+SO_BUSY_POLL = getattr(socket, 'SO_BUSY_POLL', 46)
 
 ts_struct_pat = '=7L'
 cmd_struct_pat = '=%dB'
@@ -67,6 +72,30 @@ def parse_cli():
         help='the interface to bind the receiving socket to'
     )
 
+    parser.add_argument(
+        '-e',
+        '--event-codes',
+        metavar='CODES',
+        default=None,
+        help='only pass events with one of these comma separated event codes'
+    )
+
+    parser.add_argument(
+        '--prescale',
+        metavar='PRESCALE',
+        type=int,
+        default=1,
+        help='pass every Nth event that matches the event codes (default: 1)'
+    )
+
+    parser.add_argument(
+        '--delay',
+        metavar='FIDUCIALS',
+        type=int,
+        default=0,
+        help='delay triggers by this many fiducials (default: 0)'
+    )
+
     parser.add_argument(
         '--log-level',
         metavar='LOG_LEVEL',
@@ -74,11 +103,95 @@ def parse_cli():
         help='the logging level of the client (default %s)'%default_log
     )
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.event_codes is not None:
+        # the same checks the IOC applies to its trigger settings
+        try:
+            args.event_codes = parse_event_codes(args.event_codes)
+        except ValueError as exc:
+            parser.error('invalid event codes: %s' % exc)
+        if not args.event_codes:
+            parser.error('an empty event code set would block every event')
+    if args.prescale < 1 or args.delay < 0:
+        parser.error('the prescale must be positive and the delay non-negative')
+    return args
 
 class TimeoutException(Exception):
     pass
 
+def parse_event_codes(codes):
+    """Parses a comma or space separated string of event codes."""
+    parsed = []
+    for code in codes.replace(',', ' ').split():
+        value = int(code)
+        if not 0 <= value <= 255:
+            raise ValueError("event code %d is out of range [0-255]" % value)
+        parsed.append(value)
+    return parsed
+
+class TriggerFilter(object):
+    """Event code based trigger filter shared with the listener process.
+
+    The settings live in shared memory so they can be changed from the IOC
+    while the listener is running. The listener only rereads them when the
+    generation counter changes, so an unchanged filter costs one shared
+    integer read per event.
+    """
+    NCODES = 256
+    FID_MASK = 0x1ffff
+
+    def __init__(self):
+        self.gen = mp.Value('I', 0)
+        self.codes = mp.Array('B', TriggerFilter.NCODES, lock=False)
+        self.prescale = mp.Value('I', 1, lock=False)
+        self.delay = mp.Value('I', 0, lock=False)
+        self.enabled = mp.Value('B', 0, lock=False)
+        self._gen = None
+
+    def configure(self, codes, prescale=1, delay=0, enabled=True):
+        with self.gen.get_lock():
+            for i in range(TriggerFilter.NCODES):
+                self.codes[i] = 0
+            for code in codes:
+                self.codes[code] = 1
+            self.prescale.value = max(prescale, 1)
+            self.delay.value = max(delay, 0)
+            self.enabled.value = 1 if enabled else 0
+            self.gen.value += 1
+
+    def _reload(self):
+        with self.gen.get_lock():
+            self._gen = self.gen.value
+            self._codes = frozenset(i for i in range(TriggerFilter.NCODES) if self.codes[i])
+            self._prescale = self.prescale.value
+            self._delay = self.delay.value
+            self._enabled = bool(self.enabled.value)
+        self._count = 0
+        self._pending = collections.deque()
+
+    def _reached(self, fid, target):
+        # fiducials wrap so compare using the modular difference
+        return ((fid - target) & TriggerFilter.FID_MASK) < (TriggerFilter.FID_MASK >> 1)
+
+    def accept(self, ts, cmd):
+        """Returns True if the event should be passed on to the camera."""
+        if self.gen.value != self._gen:
+            self._reload()
+        if not self._enabled:
+            return True
+        fid = ts.high & TriggerFilter.FID_MASK
+        if not self._codes.isdisjoint(cmd):
+            self._count += 1
+            if self._count >= self._prescale:
+                self._count = 0
+                self._pending.append((fid + self._delay) & TriggerFilter.FID_MASK)
+        if self._pending and self._reached(fid, self._pending[0]):
+            # several triggers may have come due on the same event
+            while self._pending and self._reached(fid, self._pending[0]):
+                self._pending.popleft()
+            return True
+        return False
+
 class SocketReceive(object):
     def __init__(self,mcast_addr,mcast_port,readout_mask,dev):
         self.readout_grp_mask = readout_mask
@@ -92,8 +205,27 @@ class SocketReceive(object):
         self.pipe = mp.Pipe()
         self.enable = mp.Lock()
         self.ts_queue = mp.Queue()
+        self.trigger = TriggerFilter()
+        self.cpus = None
+        self.priority = None
+        self.rcvbuf = None
+        self.busy_poll = None
         self.collecting = False
 
+    def tune(self, cpus=None, priority=None, rcvbuf=None, busy_poll=None):
+        """Sets the scheduling and socket options used by the listener."""
+        self.cpus = cpus
+        self.priority = priority
+        self.rcvbuf = rcvbuf
+        self.busy_poll = busy_poll
+
+    def _setsockopt(self, name, opt, value):
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, opt, value)
+            LOG.debug('Set %s to %d (effective %d)', name, value, self.sock.getsockopt(socket.SOL_SOCKET, opt))
+        except socket.error as exc:
+            LOG.warning('Could not set %s to %d: %s', name, value, exc)
+
     def _recv(self, max):
         return self.sock.recv(max)
 
@@ -104,10 +236,15 @@ class SocketReceive(object):
         return ts_data, cmd_data
 
     def listen(self):
+        affinity.apply('listener', self.cpus, self.priority)
         #create a UDP socket
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         #allow other sockets to bind this port too
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.rcvbuf:
+            self._setsockopt('SO_RCVBUF', socket.SO_RCVBUF, self.rcvbuf)
+        if self.busy_poll:
+            self._setsockopt('SO_BUSY_POLL', SO_BUSY_POLL, self.busy_poll)
         #explicitly join the multicast group on the interface specified
         if self.if_ip is None:
             mreq = struct.pack("4sl", socket.inet_aton(self.mcast_addr), socket.INADDR_ANY)
@@ -130,7 +267,7 @@ class SocketReceive(object):
                 for e in events:
                     if (e[0] == self.sock.fileno()) and (e[1] & select.POLLIN):
                         ts, cmd = self._recv_ts()
-                        if ts.group & self.readout_grp_mask:
+                        if ts.group & self.readout_grp_mask and self.trigger.accept(ts, cmd):
                             self.ts_queue.put((ts, cmd))
                     elif (e[0] == self.pipe[0].fileno()) and (e[1] & select.POLLIN):
                         msg = self.pipe[0].recv()
@@ -149,6 +286,13 @@ class SocketReceive(object):
         except Queue.Empty:
             raise TimeoutException("timeout after %.2f s"%timeout)
 
+    def qsize(self):
+        try:
+            return self.ts_queue.qsize()
+        except NotImplementedError:
+            # not available on all platforms (e.g. macOS)
+            return 0
+
     def start(self):
         if not self.collecting:
             LOG.debug("Starting daq timestamp listener")
@@ -166,6 +310,80 @@ class SocketReceive(object):
                 self.pipe[1].send("stop")
                 self.ts_proc.join()
 
+class SyntheticReceive(object):
+    """Generates timestamps at a fixed rate in place of the EVR multicasts.
+
+    Used to drive soak runs and tests without timing hardware. Each event
+    carries SYNTHETIC_EVENT_CODE so the trigger filter can be exercised.
+    """
+    FID_RATE = 360.0
+    EPICS_EPOCH = 631152000
+    SYNTHETIC_EVENT_CODE = 40
+    MAX_QUEUED = 1000
+
+    def __init__(self, rate, readout_mask):
+        self.rate = rate
+        self.readout_grp_mask = readout_mask
+        self.ts_queue = Queue.Queue(SyntheticReceive.MAX_QUEUED)
+        self.trigger = TriggerFilter()
+        self.cpus = None
+        self.priority = None
+        self.dropped = 0
+        self.collecting = False
+
+    def tune(self, cpus=None, priority=None, rcvbuf=None, busy_poll=None):
+        """Sets the scheduling options, the socket options do not apply."""
+        self.cpus = cpus
+        self.priority = priority
+
+    def listen(self):
+        affinity.apply('listener', self.cpus, self.priority)
+        period = 1.0 / self.rate
+        step = max(1, int(round(SyntheticReceive.FID_RATE / self.rate)))
+        fid = 0
+        cmd = (SyntheticReceive.SYNTHETIC_EVENT_CODE,)
+        next_time = time.time()
+        while self.collecting:
+            now = time.time()
+            secs = int(now) - SyntheticReceive.EPICS_EPOCH
+            nsecs = int((now % 1.0) * 1e9)
+            ts = TimeStamp(nsecs, secs, 0, fid, self.readout_grp_mask, 0, len(cmd))
+            if self.trigger.accept(ts, cmd):
+                try:
+                    self.ts_queue.put_nowait((ts, cmd))
+                except Queue.Full:
+                    # the camera is not keeping up so behave like a lossy socket
+                    self.dropped += 1
+            fid = (fid + step) & TriggerFilter.FID_MASK
+            next_time += period
+            delay = next_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def get(self, timeout=None):
+        try:
+            return self.ts_queue.get(timeout=timeout)
+        except Queue.Empty:
+            raise TimeoutException("timeout after %.2f s"%timeout)
+
+    def qsize(self):
+        return self.ts_queue.qsize()
+
+    def start(self):
+        if not self.collecting:
+            LOG.debug("Starting synthetic timestamp generator at %.1f Hz", self.rate)
+            self.collecting = True
+            self.ts_thread = threading.Thread(name="ts", target=self.listen)
+            self.ts_thread.setDaemon(True)
+            self.ts_thread.start()
+
+    def stop(self, wait=True):
+        if self.collecting:
+            LOG.debug("Stopping synthetic timestamp generator")
+            self.collecting = False
+            if wait:
+                self.ts_thread.join()
+
 def make_timestamp_reader(platform, readout, interface=None):
     group = MCAST_GRP%(MCAST_GRP_START + platform)
     port = MCAST_PORT + platform #+ (readout * 16)
@@ -173,6 +391,8 @@ def make_timestamp_reader(platform, readout, interface=None):
 
 def main(args):
     sock = make_timestamp_reader(args.platform, args.readout, args.interface)
+    if args.event_codes is not None:
+        sock.trigger.configure(args.event_codes, args.prescale, args.delay)
     sock.start()
     LOG.info('Multicast receiver initialized - waiting for input...')
 
@@ -185,8 +405,10 @@ if __name__ == '__main__':
     args = parse_cli()
     # Setup up the logging client
     log_level = getattr(logging, args.log_level.upper(), logging.INFO)
-    logging.basicConfig(format=FMT_STR, level=log_level)
+    log_listener = logs.setup_logging(log_level)
     try:
         main(args)
     except KeyboardInterrupt:
         LOG.info('\nExitting client!')
+    finally:
+        log_listener.stop()
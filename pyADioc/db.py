@@ -1,134 +1,242 @@
+import os
+import copy
+import json
+import glob
+import logging
 import numpy as np
 
-CONFIG = {
-    'Opal1k': {
-        'model': "Adimec",
-        'manufacturer': "1000m/CL",
-        'shape': (1024, 1024, 12),
-        'size': 2
-    },
-    'Pulnix' : {
-        'model': 'TM6740CL',
-        'manufacturer': 'PULNIX',
-        'shape': (480, 640, 10),
-        'size': 2
-    },
-    'Visar' : {
-        'model': 'C7700',
-        'manufacturer': 'Hamamatsu',
-        'shape': (1024, 1344, 16),
-        'size': 2,
-        'extra': {
-            'ScaleX_RBV' : {
-                'type': 'float',
-                'value': 1e-7,
-                'autosave' : True,
-            },
-            'ScaleY_RBV' : {
-                'type': 'float',
-                'value': 1.0,
-                'autosave' : True,
-            },
-            'TimeRange_RBV' : {
-                'type': 'enum',
-                'enums': [
-                    '0.5 ns',
-                    '1 ns',
-                    '2 ns',
-                    '5 ns',
-                    '10 ns',
-                    '20 ns',
-                    '50 ns',
-                    '100 ns',
-                    '200 ns',
-                    '500 ns',
-                    '1 us',
-                    '2 us',
-                    '5 us',
-                    '10 us',
-                    '20 us',
-                    '50 us',
-                ],
-                'value': 0,
-                'autosave' : True,
-            },
-            'TriggerMode_RBV' : {
-                'type': 'enum',
-                'enums': ['Focus', 'Operate'],
-                'value': 0,
-                'autosave' : True,
-            },
-            'GateMode_RBV' : {
-                'type': 'enum',
-                'enums': ['Normal', 'Gate', 'Open Fixed'],
-                'value': 0,
-                'autosave' : True,
-            },
-            'Shutter_RBV' : {
-                'type': 'enum',
-                'enums': ['Closed', 'Open'],
-                'value': 0,
-                'autosave' : True,
-            },
-            'ImageMode_RBV' : {
-                'type': 'enum',
-                'enums': ['Single', 'Continuous'],
-                'value': 0,
-                'autosave' : True,
-            },
-            'FocusTimeOver_RBV' : {
-                'type': 'int',
-                'value': 5,
-                'autosave' : True,
-            },
-            'ScalingFilePath' : {
-                'type': 'char',
-                'count': 10000,
-                'value': '/reg/neh/home/joaoprod/visar/mec/visar/current/VISAR1.txt',
-                'autosave' : True,
-            },
-        },
-    },
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+LOG = logging.getLogger(__name__)
+
+# Camera registry search path settings
+CAMERA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cameras')
+CAMERA_PATH_ENV = 'PYADIOC_CAMERA_PATH'
+# Frame generator modes
+FRAME_MODES = ['normal', 'uniform', 'constant']
+# Pixel types ordered by size: (max bits, pixel dtype, CA waveform type, CA dtype)
+# The CA dtype is the exact array type pcaspy posts for the waveform type, so
+# frames are handed over as a view of the pixel buffer with no conversion.
+PIXEL_TYPES = [
+    (8, np.uint8, 'char', np.uint8),
+    (16, np.uint16, 'short', np.int16),
+    (32, np.uint32, 'int', np.int32),
+]
+# Handling of events that arrive while a new configuration is being built
+RECONF_POLICIES = ['Continue', 'Drop']
+RECONF_STATUS = ['Applied', 'Failed']
+# Element sizes of the pcaspy PV types
+TYPE_SIZES = {
+    'enum': 2,
+    'string': 40,
+    'char': 1,
+    'short': 2,
+    'int': 4,
+    'float': 8,
 }
+# Headroom added to the largest array for the CA message header
+CA_HEADER_BYTES = 0x1000
+
+CONFIG = None
+
+
+class ConfigError(Exception):
+    pass
 
-def get_max_array_size(camtype):
-    size = 0x10000
-    if camtype in CONFIG:
-        height, width, _ = CONFIG[camtype]['shape']
-        size += height * width * CONFIG[camtype]['size']
+
+def _to_str(value):
+    """Recursively converts unicode strings from the json decoder to str."""
+    if isinstance(value, unicode):
+        return str(value)
+    elif isinstance(value, list):
+        return [_to_str(v) for v in value]
+    elif isinstance(value, dict):
+        return { _to_str(k) : _to_str(v) for k, v in value.iteritems() }
     else:
-        size = 40000000
+        return value
 
-    return size
+def get_search_path(extra_paths=None):
+    """Returns the list of directories to search for camera definitions."""
+    paths = [CAMERA_DIR]
+    env_path = os.environ.get(CAMERA_PATH_ENV)
+    if env_path:
+        paths.extend(p for p in env_path.split(os.pathsep) if p)
+    if extra_paths:
+        paths.extend(extra_paths)
+    return paths
 
-def get_dtype(camtype):
-    if camtype in CONFIG:
-        size = CONFIG[camtype]['size']
-        if size <= 8:
-            return np.uint8
-        elif size <= 16:
-            return np.uint16
+def char_value(value):
+    """Returns the string held by a char waveform PV value.
+
+    Clients may write char waveforms as a string or as an array of
+    character codes, either of which can be NUL terminated.
+    """
+    if not isinstance(value, basestring):
+        value = ''.join(chr(int(c)) for c in value)
+    return str(value).split('\0', 1)[0]
+
+def read_config_file(filename):
+    """Reads a dictionary of camera definitions from a json or yaml file."""
+    with open(filename, 'r') as f:
+        if filename.endswith('.json'):
+            entries = json.load(f)
+        elif yaml is not None:
+            entries = yaml.safe_load(f)
         else:
-            return np.uint32
-    else:
-        return np.uint16
+            raise ConfigError("PyYAML is needed to read camera file: %s" % filename)
+    if not isinstance(entries, dict):
+        raise ConfigError("Camera file %s does not contain a mapping" % filename)
+    return _to_str(entries)
+
+def pixel_type(bits=None, dtype=None):
+    """Returns the smallest PIXEL_TYPES entry for a bit depth or pixel dtype."""
+    for ptype in PIXEL_TYPES:
+        if dtype is not None:
+            if np.dtype(ptype[1]) == np.dtype(dtype):
+                return ptype
+        elif bits <= ptype[0]:
+            return ptype
+    raise ConfigError("No pixel type available for bits=%s dtype=%s" % (bits, dtype))
+
+def get_wire_dtype(dtype):
+    """Returns the CA array dtype used to post frames of a pixel dtype."""
+    return pixel_type(dtype=dtype)[3]
+
+def validate(camtype, entry):
+    """Checks a camera definition and fills in any optional fields."""
+    if not isinstance(entry, dict):
+        raise ConfigError("Camera %s definition is not a mapping" % camtype)
+    for key in ('model', 'manufacturer', 'shape', 'bits'):
+        if key not in entry:
+            raise ConfigError("Camera %s is missing required field '%s'" % (camtype, key))
+    try:
+        shape = tuple(int(n) for n in entry['shape'])
+        bits = int(entry['bits'])
+    except (TypeError, ValueError):
+        raise ConfigError("Camera %s has an invalid shape or bit depth: %s, %s" % (camtype, entry['shape'], entry['bits']))
+    if len(shape) != 2 or any(n <= 0 for n in shape):
+        raise ConfigError("Camera %s has an invalid shape: %s" % (camtype, entry['shape']))
+    entry['shape'] = shape
+    entry['bits'] = bits
+    if not 0 < entry['bits'] <= 32:
+        raise ConfigError("Camera %s has an invalid bit depth: %d" % (camtype, entry['bits']))
+    entry.setdefault('dtype', pixel_type(entry['bits'])[1].__name__)
+    try:
+        dtype = np.dtype(entry['dtype'])
+    except TypeError:
+        raise ConfigError("Camera %s has an invalid dtype: %s" % (camtype, entry['dtype']))
+    if dtype not in [np.dtype(ptype[1]) for ptype in PIXEL_TYPES]:
+        raise ConfigError("Camera %s dtype %s is not a supported pixel type" % (camtype, dtype))
+    if dtype.itemsize * 8 < entry['bits']:
+        raise ConfigError("Camera %s dtype %s cannot hold %d bit pixels" % (camtype, dtype, entry['bits']))
+    entry.setdefault('mode', FRAME_MODES[0])
+    if entry['mode'] not in FRAME_MODES:
+        raise ConfigError("Camera %s has an unknown frame mode: %s" % (camtype, entry['mode']))
+    entry.setdefault('extra', {})
+    if not isinstance(entry['extra'], dict):
+        raise ConfigError("Camera %s extra PVs are not a mapping" % camtype)
+    for pv, info in entry['extra'].iteritems():
+        if not isinstance(info, dict) or info.get('type') not in TYPE_SIZES:
+            raise ConfigError("Camera %s extra PV %s has an invalid type" % (camtype, pv))
+    return entry
+
+def load_config(extra_paths=None):
+    """Loads and validates the camera registry from the search path.
+
+    Files later in the search path override camera definitions of the same
+    name found earlier, so site files can replace the packaged defaults.
+    """
+    global CONFIG
+    registry = {}
+    for path in get_search_path(extra_paths):
+        if not os.path.isdir(path):
+            LOG.warning('Camera search path %s is not a directory', path)
+            continue
+        filenames = []
+        for pattern in ('*.json', '*.yaml', '*.yml'):
+            filenames.extend(glob.glob(os.path.join(path, pattern)))
+        for filename in sorted(filenames):
+            LOG.debug('Loading camera definitions from %s', filename)
+            for camtype, entry in read_config_file(filename).iteritems():
+                registry[camtype] = validate(camtype, entry)
+    CONFIG = registry
+    return CONFIG
+
+def get_config(camtype):
+    if CONFIG is None:
+        load_config()
+    return CONFIG.get(camtype)
+
+def compressed_bound(nbytes):
+    """Returns the worst case size of an encoded frame of nbytes."""
+    return nbytes + nbytes // 255 + 64
+
+def get_max_array_size(camtype, burst=0, codec=None):
+    config = get_config(camtype)
+    rows, cols = config['shape']
+    frame_size = rows * cols * np.dtype(config['dtype']).itemsize
+    size = max(burst, 1) * frame_size
+    if codec is not None:
+        size = max(size, compressed_bound(frame_size))
+    for info in config['extra'].itervalues():
+        size = max(size, info.get('count', 1) * TYPE_SIZES[info['type']])
+
+    return size + CA_HEADER_BYTES
+
+def get_dtype(camtype):
+    return np.dtype(get_config(camtype)['dtype']).type
 
-def init(camtype):
-    if camtype in CONFIG:
+def init(camtype, burst=0, codec=None, workers=2, preview=0):
+    config = get_config(camtype)
+    if config is not None:
         pvdb = init_base(
-            CONFIG[camtype]['manufacturer'],
-            CONFIG[camtype]['model'],
-            *CONFIG[camtype]['shape']
+            config['manufacturer'],
+            config['model'],
+            config['shape'][0],
+            config['shape'][1],
+            config['bits'],
+            config['mode'],
+            config['dtype'],
         )
-        extras = CONFIG[camtype].get('extra', None)
-        if extras is not None:
-            pvdb.update(extras)
+        pvdb.update(copy.deepcopy(config['extra']))
+        pvdb.update(init_trigger())
+        pvdb.update(init_reconf())
+        pvdb.update(init_detector())
+        if burst > 1:
+            pvdb.update(init_burst(
+                config['shape'][0],
+                config['shape'][1],
+                burst,
+                config['dtype'],
+            ))
+        if codec is not None:
+            pvdb.update(init_compress(
+                config['shape'][0],
+                config['shape'][1],
+                config['dtype'],
+                codec,
+                workers,
+            ))
+        if preview > 1:
+            pvdb.update(init_preview(
+                config['shape'][0],
+                config['shape'][1],
+                preview,
+                config['dtype'],
+            ))
     else:
         pvdb = None
     
     return pvdb
 
-def init_base(manufacturer, model, nrows, ncols, nbits):
+def init_base(manufacturer, model, nrows, ncols, nbits, mode, dtype=None):
+    if dtype is None:
+        wftype = pixel_type(bits=nbits)[2]
+    else:
+        wftype = pixel_type(dtype=dtype)[2]
     pvdb = {
     'FIDUCIAL': {
         'type': 'int',
@@ -141,7 +249,7 @@ def init_base(manufacturer, model, nrows, ncols, nbits):
         'readonly' : True,
     },
     'IMAGE1:ArrayData': {
-        'type': 'short',
+        'type': wftype,
         'count': nrows * ncols,
         'readonly' : True,
     },
@@ -172,21 +280,25 @@ def init_base(manufacturer, model, nrows, ncols, nbits):
     },
     'MinX_RBV' :{
         'type': 'int',
+        'config': True,
         'value': 0,
         'autosave' : True,
     },
     'MinY_RBV' :{
         'type': 'int',
+        'config': True,
         'value': 0,
         'autosave' : True,
     },
     'SizeX_RBV' :{
         'type': 'int',
+        'config': True,
         'value': nrows,
         'autosave' : True,
     },
     'SizeY_RBV' :{
         'type': 'int',
+        'config': True,
         'value': ncols,
         'autosave' : True,
     },
@@ -217,13 +329,271 @@ def init_base(manufacturer, model, nrows, ncols, nbits):
     },
     'OFFSET': {
         'type': 'int',
+        'config': True,
         'value': 100,
         'autosave': True,
     },
     'SCALE': {
         'type': 'int',
+        'config': True,
         'value': 10,
         'autosave': True,
+    },
+    'MODE': {
+        'type': 'enum',
+        'config': True,
+        'enums': FRAME_MODES,
+        'value': FRAME_MODES.index(mode),
+        'autosave': True,
+    }
+    }
+
+    return pvdb
+
+def init_burst(nrows, ncols, nframes, dtype):
+    pvdb = {
+    'BURST:ArrayData': {
+        'type': pixel_type(dtype=dtype)[2],
+        'count': nframes * nrows * ncols,
+        'readonly' : True,
+    },
+    'BURST:ArrayData.NORD': {
+        'type': 'int',
+        'value': nframes * nrows * ncols,
+        'readonly' : True,
+    },
+    'BURST:Fiducials': {
+        'type': 'int',
+        'count': nframes,
+        'readonly' : True,
+    },
+    'BURST:NumFrames_RBV': {
+        'type': 'int',
+        'value': nframes,
+        'readonly' : True,
+    },
+    'BURST:Enable': {
+        'type': 'enum',
+        'enums': ['Off', 'On'],
+        'value': 1,
+        'autosave': True,
+    }
+    }
+
+    return pvdb
+
+def init_compress(nrows, ncols, dtype, codec, workers):
+    nbytes = nrows * ncols * np.dtype(dtype).itemsize
+    pvdb = {
+    'COMPRESSED:ArrayData': {
+        'type': 'char',
+        'count': compressed_bound(nbytes),
+        'readonly' : True,
+    },
+    'COMPRESSED:ArrayData.NORD': {
+        'type': 'int',
+        'value': 0,
+        'readonly' : True,
+    },
+    'COMPRESSED:Codec_RBV': {
+        'type': 'string',
+        'value': codec,
+        'readonly' : True,
+    },
+    'COMPRESSED:DataType_RBV': {
+        'type': 'string',
+        'value': np.dtype(dtype).name,
+        'readonly' : True,
+    },
+    'COMPRESSED:Workers_RBV': {
+        'type': 'int',
+        'value': workers,
+        'readonly' : True,
+    },
+    'COMPRESSED:UncompressedSize_RBV': {
+        'type': 'int',
+        'value': nbytes,
+        'readonly' : True,
+    },
+    'COMPRESSED:CompressedSize_RBV': {
+        'type': 'int',
+        'value': 0,
+        'readonly' : True,
+    },
+    'COMPRESSED:Ratio_RBV': {
+        'type': 'float',
+        'value': 0.0,
+        'readonly' : True,
+    },
+    'COMPRESSED:Time_RBV': {
+        'type': 'float',
+        'value': 0.0,
+        'unit': 'ms',
+        'readonly' : True,
+    },
+    'COMPRESSED:Dropped_RBV': {
+        'type': 'int',
+        'value': 0,
+        'readonly' : True,
+    }
+    }
+
+    return pvdb
+
+def init_trigger():
+    pvdb = {
+    'TRIG:Enable': {
+        'type': 'enum',
+        'enums': ['Off', 'On'],
+        'value': 0,
+        'autosave': True,
+    },
+    'TRIG:EventCodes': {
+        'type': 'char',
+        'count': 256,
+        'value': '',
+        'autosave': True,
+    },
+    'TRIG:Prescale': {
+        'type': 'int',
+        'value': 1,
+        'autosave': True,
+    },
+    'TRIG:Delay': {
+        'type': 'int',
+        'value': 0,
+        'unit': 'fiducials',
+        'autosave': True,
+    }
+    }
+
+    return pvdb
+
+def init_reconf():
+    pvdb = {
+    'RECONF:Policy': {
+        'type': 'enum',
+        'enums': RECONF_POLICIES,
+        'value': 0,
+        'autosave': True,
+    },
+    'RECONF:Duration_RBV': {
+        'type': 'float',
+        'value': 0.0,
+        'unit': 'ms',
+        'readonly': True,
+    },
+    'RECONF:Events_RBV': {
+        'type': 'int',
+        'value': 0,
+        'readonly': True,
+    },
+    'RECONF:Count_RBV': {
+        'type': 'int',
+        'value': 0,
+        'readonly': True,
+    },
+    'RECONF:Status_RBV': {
+        'type': 'enum',
+        'enums': RECONF_STATUS,
+        'value': 0,
+        'readonly': True,
+    }
+    }
+
+    return pvdb
+
+def init_preview(nrows, ncols, nbin, dtype):
+    prows = nrows // nbin
+    pcols = ncols // nbin
+    pvdb = {
+    'PREVIEW:ArrayData': {
+        'type': pixel_type(dtype=dtype)[2],
+        'count': prows * pcols,
+        'readonly' : True,
+    },
+    'PREVIEW:ArrayData.NORD': {
+        'type': 'int',
+        'value': prows * pcols,
+        'readonly' : True,
+    },
+    'PREVIEW:ArraySize1_RBV': {
+        'type': 'int',
+        'value': prows,
+        'readonly' : True,
+    },
+    'PREVIEW:ArraySize0_RBV': {
+        'type': 'int',
+        'value': pcols,
+        'readonly' : True,
+    },
+    'PREVIEW:Binning_RBV': {
+        'type': 'int',
+        'value': nbin,
+        'readonly' : True,
+    },
+    'PREVIEW:Rate': {
+        'type': 'int',
+        'value': 10,
+        'autosave': True,
+    }
+    }
+
+    return pvdb
+
+def init_detector():
+    pvdb = {
+    'DETECTOR:Enable': {
+        'type': 'enum',
+        'enums': ['Off', 'On'],
+        'value': 0,
+        'config': True,
+        'autosave': True,
+    },
+    'DETECTOR:PedestalFile': {
+        'type': 'char',
+        'count': 1024,
+        'value': '',
+        'config': True,
+        'autosave': True,
+    },
+    'DETECTOR:GainFile': {
+        'type': 'char',
+        'count': 1024,
+        'value': '',
+        'config': True,
+        'autosave': True,
+    },
+    'DETECTOR:BadPixelFile': {
+        'type': 'char',
+        'count': 1024,
+        'value': '',
+        'config': True,
+        'autosave': True,
+    },
+    'DETECTOR:PedestalSigma': {
+        'type': 'float',
+        'value': 0.0,
+        'config': True,
+        'autosave': True,
+    },
+    'DETECTOR:GainSigma': {
+        'type': 'float',
+        'value': 0.0,
+        'config': True,
+        'autosave': True,
+    },
+    'DETECTOR:HotPixelFraction': {
+        'type': 'float',
+        'value': 0.0,
+        'config': True,
+        'autosave': True,
+    },
+    'DETECTOR:Seed': {
+        'type': 'int',
+        'value': 0,
+        'config': True,
+        'autosave': True,
     }
     }
 
@@ -1,9 +1,14 @@
 import os
 import db
 import sys
+import Queue
 import time
+import logs
 import daqts
+import socket
+import affinity
 import logging
+import compress
 import argparse
 import threading
 import numpy as np
@@ -13,37 +18,209 @@ from pcaspy import SimpleServer, Driver, Severity, Alarm
 
 
 LOG = logging.getLogger('pyAD_ioc')
-## LOGGING SETTINGS ##
-MAX_BYTES = 104857600
-BACKUP_COUNT = 5
-FMT_STR = '[ %(asctime)s | %(levelname)-8s] %(message)s'
 # IOC Settings
 IOC_DATA = os.getcwd()
+# How often finished compressed frames are posted while waiting for events
+COMP_POLL = 0.01
+
+
+class FrameState(object):
+    """The frame buffers and generator settings for one configuration.
+
+    States are built by the configurator thread and swapped into the
+    acquisition loop between events, so nothing here is shared with a
+    state that is still in use.
+    """
+    def __init__(self, config, sensor_shape, nbits, dtype, burst, preview):
+        nrows, ncols = sensor_shape
+        self.maxval = (1 << nbits) - 1
+        self.validate(config, sensor_shape)
+        # an ROI running past the edge of the sensor is cropped to it
+        self.min_row = config.get('MinX_RBV', 0)
+        self.min_col = config.get('MinY_RBV', 0)
+        self.rows = min(config.get('SizeX_RBV', nrows), nrows - self.min_row)
+        self.cols = min(config.get('SizeY_RBV', ncols), ncols - self.min_col)
+        self.offset = config.get('OFFSET', 0)
+        self.scale = config.get('SCALE', 0)
+        self.mode = db.FRAME_MODES[config.get('MODE', 0)]
+        self.dtype = dtype
+        self.requested = time.time()
+        self.build_model(config, sensor_shape)
+        if self.mode == 'constant':
+            # frames are never modified after generation so share one
+            work = np.full((self.rows, self.cols), self.offset, dtype=np.float64)
+            self.template = self.finish(work)
+            self.template.setflags(write=False)
+        else:
+            self.template = None
+        if burst:
+            # setParam copies the array so one buffer can be refilled right away
+            self.burst_buf = np.zeros((burst, self.rows, self.cols), dtype=dtype)
+            self.burst_fids = np.zeros(burst, dtype=np.int32)
+        self.preview = preview
+        if preview:
+            self.preview_rows = self.rows // preview
+            self.preview_cols = self.cols // preview
+
+    def validate(self, config, sensor_shape):
+        """Raises ValueError for settings the frame generator cannot use."""
+        nrows, ncols = sensor_shape
+        if not 0 <= config.get('MinX_RBV', 0) < nrows or not 0 <= config.get('MinY_RBV', 0) < ncols:
+            raise ValueError("the ROI must start inside the %dx%d sensor" % sensor_shape)
+        if config.get('SizeX_RBV', nrows) < 1 or config.get('SizeY_RBV', ncols) < 1:
+            raise ValueError("the ROI size must be positive")
+        if not 0 <= config.get('OFFSET', 0) <= self.maxval:
+            raise ValueError("OFFSET must be in the pixel range [0-%d]" % self.maxval)
+        if config.get('SCALE', 0) < 0:
+            raise ValueError("SCALE must not be negative")
+        if not 0 <= config.get('MODE', 0) < len(db.FRAME_MODES):
+            raise ValueError("unknown frame MODE %s" % config.get('MODE'))
+
+    def bin(self, frame):
+        """Returns the frame binned down by the preview factor."""
+        nbin = self.preview
+        prows = self.preview_rows
+        pcols = self.preview_cols
+        binned = frame[:prows * nbin, :pcols * nbin].reshape(prows, nbin, pcols, nbin)
+        return binned.mean(axis=(1, 3)).astype(self.dtype)
+
+    def load_map(self, filename, sensor_shape, name):
+        """Loads a per-pixel map from a .npy file and crops it to the ROI."""
+        try:
+            data = np.load(filename)
+        except (IOError, ValueError) as exc:
+            LOG.error("Could not load %s map from %s: %s", name, filename, exc)
+            return None
+        if data.shape != sensor_shape:
+            LOG.error("The %s map in %s has shape %s instead of %s", name, filename, data.shape, sensor_shape)
+            return None
+        return self.crop(data)
+
+    def crop(self, data):
+        return np.ascontiguousarray(data[self.min_row:self.min_row + self.rows, self.min_col:self.min_col + self.cols])
+
+    def build_model(self, config, sensor_shape):
+        """Loads or generates the pedestal, gain and bad pixel maps.
+
+        The pedestal and gain maps are kept in the float64 dtype the frame
+        generator works in so they are applied with in-place ufuncs without
+        any per-pixel casting, and the bad pixels are kept as flat indices.
+        """
+        self.pedestal = None
+        self.gain = None
+        self.bad_pixels = None
+        if not config.get('DETECTOR:Enable', 0):
+            return
+        rng = np.random.RandomState(config.get('DETECTOR:Seed', 0))
+        if config.get('DETECTOR:PedestalFile'):
+            self.pedestal = self.load_map(config['DETECTOR:PedestalFile'], sensor_shape, 'pedestal')
+        elif config.get('DETECTOR:PedestalSigma', 0) > 0:
+            self.pedestal = self.crop(rng.normal(0.0, config['DETECTOR:PedestalSigma'], sensor_shape))
+        if config.get('DETECTOR:GainFile'):
+            self.gain = self.load_map(config['DETECTOR:GainFile'], sensor_shape, 'gain')
+        elif config.get('DETECTOR:GainSigma', 0) > 0:
+            self.gain = self.crop(rng.normal(1.0, config['DETECTOR:GainSigma'], sensor_shape))
+        if config.get('DETECTOR:BadPixelFile'):
+            mask = self.load_map(config['DETECTOR:BadPixelFile'], sensor_shape, 'bad pixel')
+        elif config.get('DETECTOR:HotPixelFraction', 0) > 0:
+            mask = self.crop(rng.random_sample(sensor_shape) < config['DETECTOR:HotPixelFraction'])
+        else:
+            mask = None
+        if self.pedestal is not None:
+            self.pedestal = self.pedestal.astype(np.float64)
+        if self.gain is not None:
+            self.gain = self.gain.astype(np.float64)
+        if mask is not None:
+            self.bad_pixels = np.flatnonzero(mask)
+
+    def finish(self, work):
+        """Applies the detector model to the float work frame and converts it."""
+        if self.gain is not None:
+            np.multiply(work, self.gain, out=work)
+        if self.pedestal is not None:
+            np.add(work, self.pedestal, out=work)
+        np.clip(work, 0, self.maxval, out=work)
+        frame = work.astype(self.dtype)
+        if self.bad_pixels is not None and self.bad_pixels.size:
+            frame.put(self.bad_pixels, self.maxval)
+        return frame
+
+    def generate(self):
+        shape = (self.rows, self.cols)
+        if self.template is not None:
+            return self.template
+        elif self.mode == 'uniform':
+            low = min(max(self.offset, 0), self.maxval)
+            high = min(max(self.offset + self.scale, low + 1), self.maxval + 1)
+            work = np.random.randint(low, high, shape)
+            if self.gain is None and self.pedestal is None and self.bad_pixels is None:
+                return work.astype(self.dtype)
+            return self.finish(work.astype(np.float64))
+        else:
+            return self.finish(np.random.normal(self.offset, self.scale, shape))
 
 
 class CameraDriver(Driver):
-    def __init__(self, pvdb, dtype, platform, readout_grp, interface, prefix, ioc_prefix, ioc_name, config_op=None):
+    def __init__(self, pvdb, dtype, platform, readout_grp, interface, prefix, ioc_prefix, ioc_name, config_op=None, sched=None, synthetic=None):
         super(CameraDriver, self).__init__()
         self.run = True
         self.acq_count = 0
         self.prefix = prefix
         self.pvdb = pvdb
         self.dtype = dtype
+        self.wire_dtype = db.get_wire_dtype(dtype)
         self.config_op = config_op
+        self.sched = sched or {}
         self.need_conf = threading.Event()
+        self.state_lock = threading.Lock()
+        self.next_state = None
+        self.building = False
+        self.reconf_events = 0
+        self.reconf_count = 0
+        self.sensor_shape = (
+            self.pvdb['IMAGE1:ArraySize1_RBV']['value'],
+            self.pvdb['IMAGE1:ArraySize0_RBV']['value'],
+        )
+        self.init_burst()
+        self.init_compress()
+        self.init_preview()
         self.setParam('READOUT', readout_grp)
         self.setParam('PLATFORM', platform)
         self.ioc = IocAdmin(ioc_name, ioc_prefix, self, ioc_data=IOC_DATA)
         self.confpv = self.get_tagged_pvs('config')
+        self.char_pvs = set(reason for reason, info in self.pvdb.iteritems() if info.get('type') == 'char')
         self.readonly = self.get_tagged_pvs('readonly')
         self.cmds = self.get_tagged_pvs('command')
         for pv in self.pvdb.keys():
             # remove the invalid state
             self.setParamStatus(pv, Alarm.NO_ALARM, Severity.NO_ALARM)
 
-        self.configure(self.config)
-
-        self.ts = daqts.make_timestamp_reader(platform, readout_grp, interface)
+        try:
+            self.state = self.build_state(self.config)
+        except ValueError as exc:
+            LOG.warn("Restored frame settings are invalid (%s) - using the defaults", exc)
+            for reason in self.confpv:
+                if reason in self.pvdb:
+                    self.setParam(reason, self.pvdb[reason].get('value', 0))
+            self.state = self.build_state(self.config)
+        self.set_state_params(self.state)
+
+        if synthetic:
+            self.ts = daqts.SyntheticReceive(synthetic, 1<<readout_grp)
+        else:
+            self.ts = daqts.make_timestamp_reader(platform, readout_grp, interface)
+        self.ts.tune(*self.sched.get('listener', ()))
+        if not self.configure_trigger():
+            LOG.warn("Restored trigger settings are invalid - disabling the trigger filter")
+            self.setParam('TRIG:Enable', 0)
+            self.configure_trigger()
+        self.frames_published = self.ioc.metrics['frames_published_total']
+        self.publish_time = self.ioc.metrics['ca_publish_seconds']
+        self.timeouts = self.ioc.metrics['acquire_timeouts_total']
+        self.ioc.metrics['ts_queue_depth'].source = self.ts.qsize
+        self.conf_thread = threading.Thread(name="configurator", target=self.configurator)
+        self.conf_thread.setDaemon(True)
+        self.conf_thread.start()
         self.cam_thread = threading.Thread(name="camera", target=self.acquire)
         self.cam_thread.setDaemon(True)
         self.cam_thread.start()
@@ -60,57 +237,277 @@ class CameraDriver(Driver):
                 tagged.append(key)
         return tagged
 
+    def init_burst(self):
+        if 'BURST:NumFrames_RBV' in self.pvdb:
+            self.burst = self.pvdb['BURST:NumFrames_RBV']['value']
+        else:
+            self.burst = 0
+        self.burst_idx = 0
+
+    def publish_burst(self, frame, fid):
+        buf = self.state.burst_buf
+        fids = self.state.burst_fids
+        buf[self.burst_idx] = frame
+        fids[self.burst_idx] = fid & 0x1ffff
+        self.burst_idx += 1
+        if self.burst_idx == self.burst:
+            self.setParam('FIDUCIAL', fid & 0x1ffff)
+            self.setParam('BURST:ArrayData', buf.view(self.wire_dtype).reshape(-1))
+            self.patch_ts('BURST:ArrayData', fid)
+            self.setParam('BURST:ArrayData.NORD', buf.size)
+            self.setParam('BURST:Fiducials', fids)
+            self.patch_ts('BURST:Fiducials', fid)
+            self.publish(self.burst)
+            self.burst_idx = 0
+
+    def publish(self, nframes=1):
+        start = time.time()
+        self.updatePVs()
+        self.publish_time.set(time.time() - start)
+        self.frames_published.inc(nframes)
+
+    def init_preview(self):
+        if 'PREVIEW:Binning_RBV' in self.pvdb:
+            self.preview = self.pvdb['PREVIEW:Binning_RBV']['value']
+        else:
+            self.preview = 0
+        self.preview_count = 0
+
+    def update_preview(self, frame, fid):
+        rate = self.getParam('PREVIEW:Rate')
+        self.preview_count += 1
+        if rate < 1 or self.preview_count < rate:
+            return
+        self.preview_count = 0
+        if not self.state.preview_rows or not self.state.preview_cols:
+            return
+        # posted along with the next update of the image PVs
+        binned = self.state.bin(frame)
+        self.setParam('PREVIEW:ArrayData', binned.view(self.wire_dtype).reshape(-1))
+        self.patch_ts('PREVIEW:ArrayData', fid)
+        self.setParam('PREVIEW:ArrayData.NORD', binned.size)
+
+    def init_compress(self):
+        self.comp_seq = 0
+        self.comp_posted = 0
+        self.comp_dropped = 0
+        # results come back on the pool's thread so hand them to the camera thread
+        self.comp_results = Queue.Queue()
+        if 'COMPRESSED:Codec_RBV' in self.pvdb:
+            self.compressor = compress.Compressor(
+                self.pvdb['COMPRESSED:Codec_RBV']['value'],
+                self.pvdb['COMPRESSED:Workers_RBV']['value'],
+                self.comp_results.put,
+            )
+        else:
+            self.compressor = None
+
+    def update_compressed(self):
+        """Sets the newest finished compressed frame, returns True if there was one."""
+        latest = None
+        while True:
+            try:
+                result = self.comp_results.get_nowait()
+            except Queue.Empty:
+                break
+            # workers can finish out of order so never post an older frame
+            if result[0] > self.comp_posted and (latest is None or result[0] > latest[0]):
+                latest = result
+        if latest is None:
+            return False
+        seq, fid, data, nbytes, elapsed = latest
+        self.comp_posted = seq
+        self.setParam('COMPRESSED:ArrayData', data)
+        self.patch_ts('COMPRESSED:ArrayData', fid)
+        self.setParam('COMPRESSED:ArrayData.NORD', data.size)
+        self.setParam('COMPRESSED:UncompressedSize_RBV', nbytes)
+        self.setParam('COMPRESSED:CompressedSize_RBV', data.size)
+        self.setParam('COMPRESSED:Ratio_RBV', nbytes / float(max(data.size, 1)))
+        self.setParam('COMPRESSED:Time_RBV', elapsed * 1.e3)
+        return True
+
+    def wait_ts(self, timeout):
+        """Waits for the next timestamp, posting compressed frames as they finish.
+
+        Encodes finish after the frame they belong to was published, so they
+        are posted while waiting for the next event rather than with it.
+        """
+        if self.compressor is None:
+            return self.ts.get(timeout=timeout)
+        deadline = time.time() + timeout
+        while True:
+            try:
+                return self.ts.get(timeout=max(min(COMP_POLL, deadline - time.time()), 0))
+            except daqts.TimeoutException:
+                if self.update_compressed():
+                    self.updatePVs()
+                if time.time() >= deadline:
+                    raise daqts.TimeoutException("timeout after %.2f s"%timeout)
+
+    def configure_trigger(self, **changes):
+        settings = {
+            reason : changes.get(reason, self.getParam(reason))
+            for reason in ('TRIG:Enable', 'TRIG:EventCodes', 'TRIG:Prescale', 'TRIG:Delay')
+        }
+        codes = db.char_value(settings['TRIG:EventCodes'])
+        try:
+            codes = daqts.parse_event_codes(codes)
+        except ValueError as exc:
+            LOG.warn("Invalid trigger event codes '%s': %s", codes, exc)
+            return False
+        if settings['TRIG:Prescale'] < 1 or settings['TRIG:Delay'] < 0:
+            LOG.warn("Trigger prescale must be positive and delay non-negative")
+            return False
+        if settings['TRIG:Enable'] and not codes:
+            # an empty event code set would block every event
+            LOG.warn("Trigger cannot be enabled without any event codes")
+            return False
+        self.ts.trigger.configure(
+            codes,
+            settings['TRIG:Prescale'],
+            settings['TRIG:Delay'],
+            settings['TRIG:Enable'],
+        )
+        return True
+
     def patch_ts(self, reason, fid):
         self.pvDB[reason].time.nsec = (self.pvDB[reason].time.nsec & ~0x1ffff) | (fid&0x1ffff)
 
     @property
     def config(self):
-        return { name : self.getParam(name) for name in self.confpv }
+        return { name : self.get_config_param(name) for name in self.confpv }
+
+    def get_config_param(self, reason):
+        value = self.getParam(reason)
+        if reason in self.char_pvs:
+            return db.char_value(value)
+        return value
 
     def configure(self, config):
         if self.config_op is not None:
             self.config_op(config)
 
+    def build_state(self, config):
+        self.configure(config)
+        return FrameState(
+            config,
+            self.sensor_shape,
+            self.getParam('IMAGE1:BitsPerPixel_RBV'),
+            self.dtype,
+            self.burst,
+            self.preview,
+        )
+
+    def set_state_params(self, state):
+        self.setParam('IMAGE1:ArraySize1_RBV', state.rows)
+        self.setParam('IMAGE1:ArraySize0_RBV', state.cols)
+        if state.preview:
+            self.setParam('PREVIEW:ArraySize1_RBV', state.preview_rows)
+            self.setParam('PREVIEW:ArraySize0_RBV', state.preview_cols)
+
+    def configurator(self):
+        while self.run:
+            if not self.need_conf.wait(0.5):
+                continue
+            self.need_conf.clear()
+            LOG.info("Reconfiguring camera")
+            self.building = True
+            try:
+                start = time.time()
+                state = self.build_state(self.config)
+                state.requested = start
+                with self.state_lock:
+                    # a newer state replaces one that was never swapped in
+                    self.next_state = state
+                LOG.info("Reconfigure built in %.1f ms", (time.time() - start) * 1.e3)
+            except Exception as exc:
+                LOG.error("Reconfigure failed: %s", exc)
+                # the config PVs now hold values that were never applied
+                self.setParam('RECONF:Status_RBV', 1)
+                self.setParamStatus('RECONF:Status_RBV', Alarm.STATE_ALARM, Severity.MAJOR_ALARM)
+                self.updatePV('RECONF:Status_RBV')
+            finally:
+                self.building = False
+        LOG.debug('Configurator thread exitting...')
+
+    def swap_state(self):
+        with self.state_lock:
+            state = self.next_state
+            self.next_state = None
+        self.state = state
+        # a partial burst may have a different frame shape so drop it
+        self.burst_idx = 0
+        self.reconf_count += 1
+        self.set_state_params(state)
+        self.setParam('RECONF:Duration_RBV', (time.time() - state.requested) * 1.e3)
+        self.setParam('RECONF:Events_RBV', self.reconf_events)
+        self.setParam('RECONF:Count_RBV', self.reconf_count)
+        self.setParam('RECONF:Status_RBV', 0)
+        self.setParamStatus('RECONF:Status_RBV', Alarm.NO_ALARM, Severity.NO_ALARM)
+        self.reconf_events = 0
+        LOG.info("Reconfigure complete")
+
     def acquire(self):
         LOG.info("Acquiring data")
 
         last_ts = None
+        # start the listener first so it does not inherit the camera's cpus or priority
         self.ts.start()
+        affinity.apply('camera', *self.sched.get('camera', ()))
+        self.ioc.profiler.register('camera')
 
         try:
             while self.run:
-                if self.need_conf.is_set():
-                    LOG.info("Reconfiguring camera")
-                    self.configure(self.config)
-                    self.need_conf.clear()
-                    LOG.info("Reconfigure complete")
-                rows = self.getParam('IMAGE1:ArraySize1_RBV')
-                cols = self.getParam('IMAGE1:ArraySize0_RBV')
+                self.ioc.profiler.poll('camera')
                 timeout = self.getParam('TIMEOUT')
-                offset = self.getParam('OFFSET')
-                scale = self.getParam('SCALE')
                 try:
-                    ts_data, cmd_data = self.ts.get(timeout=timeout)
+                    ts_data, cmd_data = self.wait_ts(timeout)
                 except daqts.TimeoutException:
+                    self.timeouts.inc()
                     LOG.debug("Waiting for daq ts timed out after %.1f s"%timeout)
                     continue
                 evt_ts = ts_data.secs + ts_data.nsecs/1.e9
-                LOG.debug(ts_data, cmd_data)
+                LOG.debug("%s Evr Commands %s", ts_data, cmd_data)
+
+                if self.next_state is not None:
+                    self.swap_state()
+                elif self.building:
+                    # this event falls in a reconfiguration transition
+                    self.reconf_events += 1
+                    if db.RECONF_POLICIES[self.getParam('RECONF:Policy')] == 'Drop':
+                        continue
 
-                frame = np.random.normal(offset, scale, (rows, cols)).astype(self.dtype)
+                frame = self.state.generate()
                 self.acq_count+=1
 
                 # Update PV data
+                if self.preview:
+                    self.update_preview(frame, ts_data.high)
+                if self.burst and self.getParam('BURST:Enable'):
+                    self.publish_burst(frame, ts_data.high)
+                    continue
+                elif self.burst_idx:
+                    # drop a partially filled burst when burst mode is disabled
+                    self.burst_idx = 0
                 self.setParam('FIDUCIAL', ts_data.high&0x1ffff)
-                self.setParam('IMAGE1:ArrayData', frame)
+                # post a view in the CA waveform dtype so pcaspy does not convert
+                self.setParam('IMAGE1:ArrayData', frame.view(self.wire_dtype))
                 self.patch_ts('IMAGE1:ArrayData', ts_data.high)
                 self.setParam('IMAGE1:ArrayData.NORD', frame.size)
-                self.updatePVs()
+                if self.compressor is not None:
+                    self.comp_seq += 1
+                    if not self.compressor.submit(self.comp_seq, ts_data.high, frame):
+                        self.comp_dropped += 1
+                        self.setParam('COMPRESSED:Dropped_RBV', self.comp_dropped)
+                    self.update_compressed()
+                self.publish()
         finally:
+            self.ioc.profiler.unregister('camera')
             self.ts.stop()
 
     def write(self, reason, value):
         status = True
+        reconf = False
         # take proper actions
         if reason in self.readonly:
             LOG.warn("The %s PV is read-only!", reason)
@@ -119,27 +516,34 @@ class CameraDriver(Driver):
             # the IOC should exit now
             self.run = False
         elif reason in self.cmds:
-            status = getattr(self, reason.lower())(value)
+            if hasattr(self, reason.lower()):
+                status = getattr(self, reason.lower())(value)
+            else:
+                status = getattr(self.ioc, reason.lower())(value)
+        elif reason.startswith('TRIG:'):
+            status = self.configure_trigger(**{reason: value})
         elif reason in self.confpv:
             # signal if a configuration PV has changed
-            if value != self.getParam(reason):
-                self.need_conf.set()
+            if reason in self.char_pvs:
+                reconf = db.char_value(value) != self.get_config_param(reason)
+            else:
+                reconf = value != self.getParam(reason)
 
         # store the values
         if status:
             self.setParam(reason, value)
+            if reconf:
+                # only wake the configurator once the new value is visible
+                self.need_conf.set()
         return status
 
-    def read(self, reason):
-        if hasattr(self.ioc, reason.lower()):
-            return getattr(self.ioc, reason.lower())()
-        else:
-            return self.getParam(reason)
-
     def shutdown(self):
         LOG.info("Waiting for camera to exit acquistion")
         self.cam_thread.join()
+        self.conf_thread.join()
         LOG.info("Camera exitted acquistion")
+        if self.compressor is not None:
+            self.compressor.close()
 
 
 def parse_cli():
@@ -199,6 +603,130 @@ def parse_cli():
         help='The name of the IOC instance - this is needed for autosave (default: None)'
     )
 
+    parser.add_argument(
+        '-c',
+        '--camera-path',
+        metavar='CAMERA_PATH',
+        action='append',
+        default=[],
+        help='an extra directory to search for camera definition files (may be repeated)'
+    )
+
+    parser.add_argument(
+        '-b',
+        '--burst',
+        metavar='NFRAMES',
+        type=int,
+        default=0,
+        help='pack this many (at least 2) consecutive frames into the BURST:ArrayData PV (default: 0 - disabled)'
+    )
+
+    parser.add_argument(
+        '--preview',
+        metavar='NBIN',
+        type=int,
+        default=0,
+        help='publish frames binned down by NBIN on the PREVIEW:ArrayData PV (default: 0 - disabled)'
+    )
+
+    parser.add_argument(
+        '--compress',
+        metavar='CODEC',
+        default=None,
+        choices=compress.CODECS,
+        help='publish compressed frames on COMPRESSED:ArrayData using this codec (%s), not with --burst'%', '.join(compress.CODECS)
+    )
+
+    parser.add_argument(
+        '--compress-workers',
+        metavar='NWORKERS',
+        type=int,
+        default=2,
+        help='the number of compression worker threads (default: 2)'
+    )
+
+    parser.add_argument(
+        '--metrics-port',
+        metavar='PORT',
+        type=int,
+        default=None,
+        help='serve prometheus metrics on this local port'
+    )
+
+    parser.add_argument(
+        '--metrics-file',
+        metavar='METRICS_FILE',
+        default=None,
+        help='write prometheus metrics to this file for the node exporter textfile collector'
+    )
+
+    parser.add_argument(
+        '--synthetic',
+        metavar='RATE',
+        type=float,
+        default=None,
+        help='generate timestamps at RATE Hz instead of listening for the DAQ multicasts'
+    )
+
+    parser.add_argument(
+        '--soak',
+        metavar='INTERVAL',
+        type=float,
+        default=None,
+        help='sample memory and allocation statistics every INTERVAL seconds (exit code 3 if memory grew steadily)'
+    )
+
+    parser.add_argument(
+        '--soak-duration',
+        metavar='SECONDS',
+        type=float,
+        default=None,
+        help='stop the IOC after this many seconds of a soak run (default: run until stopped)'
+    )
+
+    parser.add_argument(
+        '--soak-top',
+        metavar='N',
+        type=int,
+        default=10,
+        help='the number of allocation changes written per soak snapshot (default: 10)'
+    )
+
+    sched_group = parser.add_argument_group('scheduling options')
+
+    for thread in ('listener', 'camera', 'ca'):
+        sched_group.add_argument(
+            '--%s-cpus'%thread,
+            metavar='CPUS',
+            type=affinity.parse_cpus,
+            default=None,
+            help='pin the %s to this cpu list, e.g. 0-3,6'%thread
+        )
+
+        sched_group.add_argument(
+            '--%s-priority'%thread,
+            metavar='PRIORITY',
+            type=int,
+            default=None,
+            help='run the %s with this SCHED_FIFO priority'%thread
+        )
+
+    sched_group.add_argument(
+        '--rcvbuf',
+        metavar='BYTES',
+        type=int,
+        default=None,
+        help='the SO_RCVBUF size of the timestamp socket'
+    )
+
+    sched_group.add_argument(
+        '--busy-poll',
+        metavar='USECS',
+        type=int,
+        default=None,
+        help='the SO_BUSY_POLL time of the timestamp socket'
+    )
+
     parser.add_argument(
         '--log-level',
         metavar='LOG_LEVEL',
@@ -225,36 +753,69 @@ def check_prefix(prefix):
             return prefix + ':'
 
 
-def run_ioc(camera_type, ioc_name, prefix, platform, readout_grp, interface):
+def run_ioc(camera_type, ioc_name, prefix, platform, readout_grp, interface, camera_path=None, burst=0, codec=None, workers=2, metrics_port=None, metrics_file=None, sched=None, preview=0, synthetic=None, soak=None, soak_top=10, soak_duration=None):
     LOG.info('%s camera server, abort with Ctrl-C', camera_type)
     ioc_prefix = "IOC:%s"%prefix
-    pvdb = db.init(camera_type)
+    if burst < 0 or burst == 1:
+        LOG.error('The burst size must be at least 2 frames: %d', burst)
+        return 2
+    try:
+        registry = db.load_config(camera_path)
+    except (db.ConfigError, IOError, ValueError) as exc:
+        LOG.error('Failed to load camera definitions: %s', exc)
+        return 2
+    pvdb = db.init(camera_type, burst, codec, workers, preview)
     if pvdb is None:
-        LOG.error('Unsupported camera type: %s', camera_type)
+        LOG.error('Unsupported camera type: %s (available: %s)', camera_type, ', '.join(sorted(registry)))
+        return 2
+    if codec is not None and not compress.available(codec):
+        LOG.error('The python module for the %s codec is not installed', codec)
+        return 2
+    if codec is not None and burst:
+        LOG.error('Compressed frames are not published in burst mode')
         return 2
 
     dtype = db.get_dtype(camera_type)
 
-    os.environ['EPICS_CA_MAX_ARRAY_BYTES'] = str(db.get_max_array_size(camera_type))
+    os.environ['EPICS_CA_MAX_ARRAY_BYTES'] = str(db.get_max_array_size(camera_type, burst, codec))
 
     server = SimpleServer()
     server.createPV(prefix, pvdb)
     server.createPV(ioc_prefix, IocAdmin.ioc_pvdb)
-    driver = CameraDriver(pvdb, dtype, platform, readout_grp, interface, prefix, ioc_prefix, ioc_name)
+    sched = sched or {}
+    driver = CameraDriver(pvdb, dtype, platform, readout_grp, interface, prefix, ioc_prefix, ioc_name, sched=sched, synthetic=synthetic)
+    driver.ioc.metrics.textfile = metrics_file
+    if metrics_port is not None:
+        try:
+            driver.ioc.metrics.serve(metrics_port)
+        except socket.error as exc:
+            LOG.error('Could not serve metrics on port %d: %s', metrics_port, exc)
     LOG.debug('%s camera server is now started', camera_type)
+    soak_end = None
+    if soak:
+        driver.ioc.start_soak(soak, soak_top)
+        if soak_duration:
+            soak_end = time.time() + soak_duration
+    affinity.apply('ca', *sched.get('ca', ()))
+    driver.ioc.profiler.register('ca')
     try:
         while driver.run:
+            driver.ioc.profiler.poll('ca')
             try:
                 # process CA transactions
                 server.process(0.1)
             except KeyboardInterrupt:
                 LOG.info('%s camera server stopped by console interrupt!', camera_type)
                 driver.run = False
+            if soak_end is not None and time.time() >= soak_end:
+                LOG.info('%s camera server soak run finished after %.0f s', camera_type, soak_duration)
+                driver.run = False
     finally:
         # process CA transactions
         server.process(0.1)
         server.process(0.1)
         # why 2? only psi knows...
+        driver.ioc.profiler.unregister('ca')
         driver.shutdown()
         # do a final autosave
         driver.ioc.shutdown()
@@ -263,6 +824,9 @@ def run_ioc(camera_type, ioc_name, prefix, platform, readout_grp, interface):
     if driver.run:
         LOG.error('%s camera server exited unexpectedly!', camera_type)
         return 1
+    elif driver.ioc.soak_growing:
+        LOG.error('%s camera server memory grew steadily during the soak run', camera_type)
+        return 3
     else:
         LOG.info('%s camera server exited normally', camera_type)
         return 0
@@ -274,15 +838,18 @@ def main():
 
     # Setup up the logging client
     log_level = getattr(logging, args.log_level.upper(), logging.INFO)
-    logging.basicConfig(format=FMT_STR, level=log_level)
-    if args.log_file is not None:
-        log_fmt = logging.Formatter(FMT_STR)
-        file_handler = RotatingFileHandler(args.log_file, MAX_BYTES, BACKUP_COUNT)
-        file_handler.setLevel(log_level)
-        file_handler.setFormatter(log_fmt)
-        LOG.addHandler(file_handler)
-
-    return run_ioc(args.camera_type, args.name, prefix, args.platform, args.readout, args.interface)
+    log_listener = logs.setup_logging(log_level, args.log_file, rate_limit=True)
+
+    sched = {
+        'listener': (args.listener_cpus, args.listener_priority, args.rcvbuf, args.busy_poll),
+        'camera': (args.camera_cpus, args.camera_priority),
+        'ca': (args.ca_cpus, args.ca_priority),
+    }
+
+    try:
+        return run_ioc(args.camera_type, args.name, prefix, args.platform, args.readout, args.interface, args.camera_path, args.burst, args.compress, args.compress_workers, args.metrics_port, args.metrics_file, sched, args.preview, args.synthetic, args.soak, args.soak_top, args.soak_duration)
+    finally:
+        log_listener.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,212 @@
+import os
+import time
+import Queue
+import logging
+import threading
+
+from logging.handlers import RotatingFileHandler
+
+FMT_STR = '[ %(asctime)s | %(levelname)-8s] %(message)s'
+MAX_BYTES = 104857600
+BACKUP_COUNT = 5
+# Rate limiting settings: messages per call site per interval
+RATE_INTERVAL = 10.0
+RATE_BURST = 5
+# How often the listener thread reports suppressed messages
+FLUSH_INTERVAL = 1.0
+
+
+class QueueHandler(logging.Handler):
+    """Hands log records to a QueueListener instead of emitting them.
+
+    Records are queued unformatted so the formatting happens on the listener
+    thread, which means the arguments passed to the logger must not be
+    modified after the call (the timestamp tuples used here are immutable).
+    In a forked child, e.g. the timestamp listener process, there is no
+    listener thread and the parent's handlers and locks may be held by
+    threads that were not forked, so records go to a console handler made
+    fresh in the child.
+    """
+    def __init__(self, queue, level=logging.NOTSET, formatter=None):
+        logging.Handler.__init__(self, level)
+        self.queue = queue
+        self.formatter = formatter
+        self.pid = os.getpid()
+        self.child = None
+
+    def handle(self, record):
+        # the queue does its own locking so the handler lock is not taken
+        if os.getpid() != self.pid:
+            return self.child_handler().handle(record)
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
+    def child_handler(self):
+        pid = os.getpid()
+        if self.child is None or self.child[0] != pid:
+            handler = logging.StreamHandler()
+            handler.setLevel(self.level)
+            handler.setFormatter(self.formatter)
+            self.child = (pid, handler)
+        return self.child[1]
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            pass
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """Emits the records from a queue to a set of handlers on its own thread.
+
+    If a RateLimitFilter is given, the summaries of the messages it dropped
+    are emitted from this thread once their interval has passed.
+    """
+    def __init__(self, queue, handlers, limiter=None):
+        self.queue = queue
+        self.handlers = handlers
+        self.limiter = limiter
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(name="logging", target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self):
+        next_flush = time.time() + FLUSH_INTERVAL
+        while True:
+            try:
+                record = self.queue.get(timeout=FLUSH_INTERVAL)
+            except Queue.Empty:
+                pass
+            else:
+                if record is None:
+                    break
+                self.handle(record)
+            if self.limiter is not None and time.time() >= next_flush:
+                self.flush()
+                next_flush = time.time() + FLUSH_INTERVAL
+        # report anything still being suppressed on exit
+        self.flush(force=True)
+
+    def flush(self, force=False):
+        if self.limiter is not None:
+            for summary in self.limiter.expire(force):
+                self.handle(summary)
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        for handler in self.handlers:
+            handler.close()
+
+
+class RateLimitFilter(logging.Filter):
+    """Limits each logging call site to burst messages per interval.
+
+    Only records at or below level are limited, which by default covers the
+    per-frame debug messages of the acquisition loop. Messages over the
+    limit are dropped and counted, and expire() returns a summary record for
+    each call site whose interval has ended with messages dropped.
+    """
+    def __init__(self, interval=RATE_INTERVAL, burst=RATE_BURST, level=logging.DEBUG):
+        logging.Filter.__init__(self)
+        self.interval = interval
+        self.burst = burst
+        self.level = level
+        self.sites = {}
+        self.expired = []
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > self.level:
+            return True
+        with self.lock:
+            return self._filter(record)
+
+    def _filter(self, record):
+        key = (record.name, record.pathname, record.lineno)
+        now = time.time()
+        site = self.sites.get(key)
+        if site is None or now - site[0] >= self.interval:
+            if site is not None and site[2]:
+                # keep the count for the listener thread to report
+                self.expired.append(self.summary(site, now))
+            self.sites[key] = [now, 1, 0, None]
+            return True
+        elif site[1] < self.burst:
+            site[1] += 1
+            return True
+        else:
+            site[2] += 1
+            site[3] = record
+            return False
+
+    def summary(self, site, now):
+        start, passed, suppressed, record = site
+        # keep the call site of the dropped messages but not their times
+        attrs = dict((k, v) for k, v in record.__dict__.iteritems()
+                     if k not in ('created', 'msecs', 'relativeCreated', 'asctime', 'message'))
+        attrs['msg'] = "%d messages like '%s' suppressed in the last %.0f s" % (
+            suppressed, record.msg, now - start)
+        attrs['args'] = None
+        return logging.makeLogRecord(attrs)
+
+    def expire(self, force=False):
+        """Returns the summary records of the call sites whose interval ended."""
+        now = time.time()
+        with self.lock:
+            summaries, self.expired = self.expired, []
+            for key, site in self.sites.items():
+                if force or now - site[0] >= self.interval:
+                    if site[2]:
+                        summaries.append(self.summary(site, now))
+                    del self.sites[key]
+        return summaries
+
+
+def setup_logging(log_level, log_file=None, fmt=FMT_STR, rate_limit=False):
+    """Routes all logging through a queue to console and file handlers.
+
+    If rate_limit is set, the debug messages of each call site are limited
+    with a RateLimitFilter. Returns the started QueueListener, which should
+    be stopped on exit to flush any queued records.
+    """
+    log_fmt = logging.Formatter(fmt)
+    handlers = []
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(log_level)
+    console_handler.setFormatter(log_fmt)
+    handlers.append(console_handler)
+    if log_file is not None:
+        file_handler = RotatingFileHandler(log_file, maxBytes=MAX_BYTES, backupCount=BACKUP_COUNT)
+        file_handler.setLevel(log_level)
+        file_handler.setFormatter(log_fmt)
+        handlers.append(file_handler)
+
+    queue = Queue.Queue()
+    queue_handler = QueueHandler(queue, log_level, log_fmt)
+    limiter = None
+    if rate_limit:
+        limiter = RateLimitFilter()
+        queue_handler.addFilter(limiter)
+    root = logging.getLogger()
+    root.setLevel(log_level)
+    root.addHandler(queue_handler)
+
+    listener = QueueListener(queue, handlers, limiter)
+    listener.start()
+    return listener
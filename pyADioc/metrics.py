@@ -0,0 +1,146 @@
+import os
+import logging
+import resource
+import threading
+import BaseHTTPServer
+
+LOG = logging.getLogger(__name__)
+
+NAMESPACE = 'pyadioc'
+
+# name, prometheus type, PV reason, help text
+METRICS = [
+    ('frames_published_total', 'counter', 'METRICS:FramesPublished', 'Frames published to CA'),
+    ('ts_queue_depth', 'gauge', 'METRICS:QueueDepth', 'Timestamps waiting in the listener queue'),
+    ('acquire_timeouts_total', 'counter', 'METRICS:Timeouts', 'Timeouts waiting for DAQ timestamps'),
+    ('autosave_duration_seconds', 'gauge', 'METRICS:AutosaveTime', 'Duration of the last autosave'),
+    ('ca_publish_seconds', 'gauge', 'METRICS:PublishTime', 'Duration of the last CA monitor post'),
+    ('process_resident_memory_bytes', 'gauge', 'METRICS:RSS', 'Resident memory size of the IOC'),
+    ('process_cpu_seconds_total', 'counter', 'METRICS:CPU', 'User and system CPU time of the IOC'),
+]
+
+
+def init_pvdb():
+    pvdb = {}
+    for name, mtype, reason, doc in METRICS:
+        pvdb[reason] = {
+            'type' : 'float',
+            'readonly' : True,
+        }
+    return pvdb
+
+def read_rss():
+    """Returns the resident memory of this process in bytes."""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        # falls back to the peak value on platforms without procfs
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def read_cpu():
+    """Returns the user and system CPU time of this process in seconds."""
+    times = os.times()
+    return times[0] + times[1]
+
+
+class Metric(object):
+    def __init__(self, name, mtype, reason, doc):
+        self.name = name
+        self.mtype = mtype
+        self.reason = reason
+        self.doc = doc
+        self.value = 0
+        self.source = None
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+    def collect(self):
+        if self.source is not None:
+            try:
+                self.value = self.source()
+            except Exception as exc:
+                LOG.debug('Could not collect metric %s: %s', self.name, exc)
+        return self.value
+
+
+class Registry(object):
+    """The performance metrics of one IOC.
+
+    The hot paths only touch the Metric objects directly. Metrics backed by
+    a source function are sampled by collect(), which the IOC admin ticker
+    calls once a second before refreshing the metric PVs and any textfile.
+    """
+    def __init__(self, labels=None):
+        self.labels = labels or {}
+        self.metrics = [Metric(*info) for info in METRICS]
+        self.by_name = { metric.name : metric for metric in self.metrics }
+        self.by_name['process_resident_memory_bytes'].source = read_rss
+        self.by_name['process_cpu_seconds_total'].source = read_cpu
+        self.textfile = None
+        self.httpd = None
+
+    def __getitem__(self, name):
+        return self.by_name[name]
+
+    def collect(self):
+        for metric in self.metrics:
+            metric.collect()
+        if self.textfile is not None:
+            self.write_textfile()
+
+    def render(self):
+        """Returns the metrics in the prometheus text exposition format."""
+        labels = ','.join('%s="%s"' % (k, v) for k, v in sorted(self.labels.iteritems()))
+        if labels:
+            labels = '{%s}' % labels
+        lines = []
+        for metric in self.metrics:
+            name = '%s_%s' % (NAMESPACE, metric.name)
+            lines.append('# HELP %s %s' % (name, metric.doc))
+            lines.append('# TYPE %s %s' % (name, metric.mtype))
+            lines.append('%s%s %s' % (name, labels, repr(float(metric.value))))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self):
+        # write then rename so the collector never reads a partial file
+        tmpname = self.textfile + '.tmp'
+        try:
+            with open(tmpname, 'w') as f:
+                f.write(self.render())
+            os.rename(tmpname, self.textfile)
+        except (IOError, OSError) as exc:
+            LOG.error('Could not write metrics file %s: %s', self.textfile, exc)
+
+    def serve(self, port, addr='127.0.0.1'):
+        registry = self
+
+        class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                LOG.debug('metrics request: ' + fmt, *args)
+
+        self.httpd = BaseHTTPServer.HTTPServer((addr, port), MetricsHandler)
+        thread = threading.Thread(name="metrics", target=self.httpd.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        LOG.info('Serving metrics on http://%s:%d/metrics', addr, port)
+
+    def shutdown(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd = None
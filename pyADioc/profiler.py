@@ -0,0 +1,165 @@
+import os
+import sys
+import time
+import pstats
+import cProfile
+import logging
+import datetime
+import threading
+import collections
+
+LOG = logging.getLogger(__name__)
+
+MODES = ['cProfile', 'Sampling']
+# Seconds between stack samples in sampling mode
+SAMPLE_INTERVAL = 0.005
+# Seconds to wait for the profiled threads to hand back their profiles
+HANDOFF_TIMEOUT = 30.0
+
+
+class Profiler(object):
+    """On demand profiler for the long running IOC threads.
+
+    Threads that take part call register() once and poll() on every pass of
+    their main loop. In cProfile mode each thread enables its own profiler
+    from poll() since cProfile only sees the thread that enabled it. In
+    sampling mode a separate thread samples the stacks of the registered
+    threads, so poll() has nothing to do. While no profile is running poll()
+    is just two attribute checks.
+    """
+    def __init__(self, outdir):
+        self.outdir = outdir
+        self.mode = None
+        self.threads = {}
+        self.profiles = {}
+        self.finished = {}
+        self.samples = collections.Counter()
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+        self.sampler = None
+        self.writer = None
+
+    @property
+    def active(self):
+        return self.mode is not None
+
+    def register(self, name):
+        self.threads[name] = threading.current_thread().ident
+
+    def unregister(self, name):
+        self.threads.pop(name, None)
+        self._release(name)
+
+    def poll(self, name):
+        if self.mode == 'cProfile':
+            if name not in self.profiles:
+                prof = cProfile.Profile()
+                self.profiles[name] = prof
+                prof.enable()
+        elif self.profiles:
+            self._release(name)
+
+    def _release(self, name):
+        prof = self.profiles.pop(name, None)
+        if prof is not None:
+            prof.disable()
+            with self.done:
+                self.finished[name] = prof
+                self.done.notify_all()
+
+    def start(self, mode):
+        if self.active:
+            LOG.warning('Profiler is already running in %s mode', self.mode)
+            return False
+        if self.writer is not None and self.writer.is_alive():
+            # the writer still reads the results of the previous run
+            LOG.warning('Profiler is still writing the results of the previous run')
+            return False
+        if mode not in MODES:
+            LOG.error('Unknown profiler mode: %s', mode)
+            return False
+        LOG.info('Starting %s profiler on threads: %s', mode, ', '.join(sorted(self.threads)))
+        self.finished.clear()
+        self.samples.clear()
+        self.mode = mode
+        if mode == 'Sampling':
+            self.sampler = threading.Thread(name="sampler", target=self.sample)
+            self.sampler.setDaemon(True)
+            self.sampler.start()
+        return True
+
+    def stop(self, callback=None, wait=False):
+        """Stops profiling and writes the results from a separate thread.
+
+        The callback is passed the output path once it has been written, or
+        None if nothing could be written.
+        """
+        if not self.active:
+            return False
+        mode = self.mode
+        self.mode = None
+        # the calling thread cannot poll while it waits, so release it here
+        for name, ident in self.threads.items():
+            if ident == threading.current_thread().ident:
+                self._release(name)
+        self.writer = threading.Thread(name="profwriter", target=self.write, args=(mode, callback))
+        self.writer.setDaemon(True)
+        self.writer.start()
+        if wait:
+            self.writer.join()
+        return True
+
+    def write(self, mode, callback):
+        try:
+            path = self.dump(mode)
+        except (IOError, OSError) as e:
+            LOG.error('Could not write profiler output: %s', e)
+            path = None
+        if callback is not None:
+            callback(path)
+
+    def dump(self, mode):
+        if not os.path.isdir(self.outdir):
+            os.makedirs(self.outdir)
+        stamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        if mode == 'Sampling':
+            self.sampler.join()
+            path = os.path.join(self.outdir, '%s.collapsed' % stamp)
+            with open(path, 'w') as f:
+                for stack, count in sorted(self.samples.iteritems()):
+                    f.write('%s %d\n' % (stack, count))
+        else:
+            # the other threads hand back their profiles on their next poll
+            deadline = time.time() + HANDOFF_TIMEOUT
+            with self.done:
+                while self.profiles and time.time() < deadline:
+                    self.done.wait(deadline - time.time())
+            stats = None
+            for name, prof in self.finished.iteritems():
+                if stats is None:
+                    stats = pstats.Stats(prof)
+                else:
+                    stats.add(prof)
+            if stats is None:
+                LOG.warning('No profiles were collected')
+                return None
+            path = os.path.join(self.outdir, '%s.pstats' % stamp)
+            stats.dump_stats(path)
+        LOG.info('Profiler results written to %s', path)
+        return path
+
+    def sample(self):
+        idents = { ident : name for name, ident in self.threads.items() }
+        while self.mode == 'Sampling':
+            frames = sys._current_frames()
+            for ident, name in idents.iteritems():
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                if stack:
+                    stack.append(name)
+                    self.samples[';'.join(reversed(stack))] += 1
+            time.sleep(SAMPLE_INTERVAL)
@@ -0,0 +1,195 @@
+import os
+import gc
+import time
+import logging
+import datetime
+import threading
+import collections
+import numpy as np
+
+from metrics import read_rss
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+LOG = logging.getLogger(__name__)
+
+# Number of snapshot diff files to keep
+SNAPSHOT_KEEP = 24
+# Frames of traceback kept by tracemalloc
+TRACE_DEPTH = 10
+# Samples ignored at the start while the IOC warms up
+WARMUP_SAMPLES = 3
+# Samples needed, fraction of non-decreasing steps and fitted growth to flag a leak
+MIN_SAMPLES = 10
+MIN_RISING = 0.8
+MIN_GROWTH = 1 << 20
+# Maximum RSS samples kept for the growth check
+MAX_SAMPLES = 10000
+
+
+def init_pvdb():
+    pvdb = {}
+    for reason in ('SOAK:RSS', 'SOAK:NumpyBytes', 'SOAK:TracedBytes'):
+        pvdb[reason] = {
+            'type' : 'float',
+            'readonly' : True,
+        }
+    for reason in ('SOAK:PyObjects', 'SOAK:NumpyArrays', 'SOAK:Samples'):
+        pvdb[reason] = {
+            'type' : 'int',
+            'readonly' : True,
+        }
+    pvdb['SOAK:Growing'] = {
+        'type' : 'enum',
+        'enums' : ['No', 'Yes'],
+        'readonly' : True,
+    }
+    return pvdb
+
+def count_arrays(objects):
+    """Returns the number and size of the numpy arrays owning their data.
+
+    ndarrays are not tracked by the garbage collector so they are found
+    through the referents of the gc tracked objects that are passed in. Views, e.g. the frames
+    published to CA, are followed back to the array owning their data so
+    that each buffer is counted once.
+    """
+    arrays = {}
+    for obj in objects:
+        for ref in gc.get_referents(obj):
+            if isinstance(ref, np.ndarray):
+                while isinstance(ref.base, np.ndarray):
+                    ref = ref.base
+                arrays[id(ref)] = ref.nbytes
+    return len(arrays), sum(arrays.itervalues())
+
+def count_types(objects):
+    """Returns a Counter of the gc tracked objects by type name."""
+    return collections.Counter(type(obj).__name__ for obj in objects)
+
+def is_growing(samples):
+    """Checks a series of RSS samples for steady monotonic growth.
+
+    RSS moves in whole pages and often holds still between samples, so the
+    growth is taken from a least-squares fit rather than the end points and
+    flat steps count as non-decreasing.
+    """
+    samples = samples[WARMUP_SAMPLES:]
+    if len(samples) < MIN_SAMPLES:
+        return False
+    slope = np.polyfit(np.arange(len(samples)), np.asarray(samples, dtype=np.float64), 1)[0]
+    rising = sum(1 for a, b in zip(samples, samples[1:]) if b >= a)
+    return slope * (len(samples) - 1) > MIN_GROWTH and rising >= MIN_RISING * (len(samples) - 1)
+
+
+class SoakMonitor(object):
+    """Samples memory and allocation statistics for long running IOCs.
+
+    Every interval the RSS, the python object and numpy array counts and,
+    when tracemalloc is available, the traced python allocations are
+    published through the update callback, and the top allocation changes
+    since the previous sample are written to a file in outdir. Without
+    tracemalloc (python 2) the diff is of live object counts by type.
+    """
+    def __init__(self, outdir, interval, top, update):
+        self.outdir = outdir
+        self.interval = interval
+        self.top = top
+        self.update = update
+        self.samples = []
+        self.running = threading.Event()
+        self.thread = None
+        self.last = None
+
+    def start(self):
+        if not os.path.isdir(self.outdir):
+            os.makedirs(self.outdir)
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACE_DEPTH)
+        LOG.info('Soak monitor sampling every %.0f s to %s', self.interval, self.outdir)
+        self.running.set()
+        self.thread = threading.Thread(name="soak", target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """Stops sampling, returns True if memory grew steadily over the run."""
+        if self.thread is not None:
+            self.running.clear()
+            self.thread.join()
+            self.thread = None
+        growing = is_growing(self.samples)
+        if growing:
+            LOG.error('Soak run shows monotonic memory growth: RSS %d -> %d bytes over %d samples',
+                      self.samples[WARMUP_SAMPLES], self.samples[-1], len(self.samples) - WARMUP_SAMPLES)
+        return growing
+
+    def run(self):
+        while self.running.is_set():
+            try:
+                self.sample()
+            except Exception as exc:
+                LOG.error('Soak sample failed: %s', exc)
+            # wait for the interval but wake promptly on stop
+            deadline = time.time() + self.interval
+            while self.running.is_set() and time.time() < deadline:
+                time.sleep(min(1.0, deadline - time.time()))
+        LOG.debug('Soak monitor thread exitting...')
+
+    def sample(self):
+        rss = read_rss()
+        self.samples.append(rss)
+        if len(self.samples) > MAX_SAMPLES:
+            # keep the warm up samples as the baseline
+            del self.samples[WARMUP_SAMPLES]
+        # walk the heap only once per sample since the walk holds the GIL
+        objects = gc.get_objects()
+        narrays, array_bytes = count_arrays(objects)
+        types = count_types(objects) if tracemalloc is None else None
+        nobjects = len(objects)
+        del objects
+        stats = {
+            'SOAK:RSS': rss,
+            'SOAK:PyObjects': nobjects,
+            'SOAK:NumpyArrays': narrays,
+            'SOAK:NumpyBytes': array_bytes,
+            'SOAK:TracedBytes': tracemalloc.get_traced_memory()[0] if tracemalloc is not None else 0,
+            'SOAK:Samples': len(self.samples),
+            'SOAK:Growing': 1 if is_growing(self.samples) else 0,
+        }
+        self.update(stats)
+        self.write_diff(stats, types)
+
+    def write_diff(self, stats, types):
+        if tracemalloc is not None:
+            current = tracemalloc.take_snapshot()
+            if self.last is not None:
+                lines = [str(stat) for stat in current.compare_to(self.last, 'lineno')[:self.top]]
+            else:
+                lines = [str(stat) for stat in current.statistics('lineno')[:self.top]]
+        else:
+            current = types
+            if self.last is not None:
+                diff = current.copy()
+                diff.subtract(self.last)
+            else:
+                diff = current
+            changes = sorted(diff.iteritems(), key=lambda item: abs(item[1]), reverse=True)[:self.top]
+            lines = ['%s: %+d (total %d)' % (name, change, current[name]) for name, change in changes]
+        self.last = current
+        stamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        filename = os.path.join(self.outdir, '%s.txt' % stamp)
+        with open(filename, 'w') as f:
+            for reason, value in sorted(stats.iteritems()):
+                f.write('# %s %s\n' % (reason, value))
+            for line in lines:
+                f.write(line + '\n')
+        self.remove_oldest_files()
+
+    def remove_oldest_files(self):
+        files = sorted(f for f in os.listdir(self.outdir) if f.endswith('.txt'))
+        for oldest in files[:-SNAPSHOT_KEEP]:
+            os.remove(os.path.join(self.outdir, oldest))
@@ -21,10 +21,17 @@ setup(
     author='Daniel Damiani',
     author_email='ddamiani@slac.stanford.edu',
     packages=['pyADioc'],
+    package_data={
+        'pyADioc': ['cameras/*.json'],
+    },
     install_requires=[
         'numpy',
         'pcaspy',
     ],
+    extras_require={
+        'yaml': ['PyYAML'],
+        'compress': ['lz4', 'zstandard', 'blosc'],
+    },
     entry_points={
         'console_scripts': [
             'pycamioc = pyADioc.ioc:main',